@@ -0,0 +1,394 @@
+"""
+Load tests and micro-benchmarks with a machine-readable baseline.
+
+Scenarios:
+    upload      POST /upload with a synthetic corpus of varied sizes and formats
+    search      GET /search driven by simulated typists: keystrokes with random
+                gaps, debounced like the search page, so only the prefixes the
+                frontend would send are requested
+    stats       GET /stats
+    my-uploads  GET /my-uploads for the IPs that uploaded
+    process     process_file() over the synthetic corpus, in this process
+
+Each scenario reports request count, errors, throughput and p50/p95/p99
+latency. --output writes the report as JSON; --compare prints the change
+against an earlier report, so runs can be diffed between releases.
+
+Uploads are spread over synthetic client IPs (sent as CF-Connecting-IP) so the
+per-IP quota doesn't cap the run. Run against docker-compose.test.yml, from
+inside the network:
+    docker-compose -f docker-compose.test.yml exec fastapi python benchmark.py --output /tmp/baseline.json
+
+Usage:
+    python benchmark.py [--target http://nginx] [--scenarios upload,search,stats,my-uploads,process]
+                        [--concurrency 8] [--requests 200] [--uploads 100] [--seed 1] [--run-id 1]
+                        [--output report.json] [--compare previous.json]
+"""
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+from PIL import Image
+import aiohttp
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from image_processing import process_file
+from storage import LocalStorage, rendition_prefix
+
+DEFAULT_TARGET = os.getenv("BENCHMARK_TARGET", "http://nginx")
+SCENARIOS = ["upload", "search", "stats", "my-uploads", "process"]
+
+# (width, height, formats) - PNG only at sizes that stay under the 10MB upload limit
+IMAGE_PROFILES = [
+    (320, 240, ["JPEG", "PNG", "WEBP", "GIF"]),
+    (1280, 960, ["JPEG", "PNG", "WEBP"]),
+    (2560, 1920, ["JPEG", "WEBP"]),
+    (4000, 3000, ["JPEG"]),
+]
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "GIF": ".gif"}
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+VOCABULARY = [
+    "sunset", "mountain", "river", "portrait", "street", "harbor", "forest", "desert",
+    "winter", "garden", "bridge", "skyline", "market", "lighthouse", "meadow", "canyon",
+    "festival", "railway", "island", "glacier", "vineyard", "village", "orchard", "storm",
+]
+
+UPLOADS_PER_IP = 20  # Below the default per-IP quota of 25
+SEARCH_DEBOUNCE = 0.5  # seconds; matches the search page
+KEYSTROKE_GAP_MEAN = 0.18  # seconds between keystrokes
+KEYSTROKE_PAUSE_CHANCE = 0.15  # chance a gap is a pause long enough to fire the debounce
+
+# --- Synthetic corpus ---
+
+def synthetic_image(rng: random.Random, noise_rng: random.Random, width: int, height: int, fmt: str) -> bytes:
+    """
+    Gradient, noise and a random colour, so every image compresses like a photo.
+    The noise comes from its own generator so a new run id changes the pixels
+    (no duplicates of an earlier run) while sizes, formats and names stay put.
+    """
+    gradient = Image.linear_gradient("L").resize((width, height))
+    # Uniform bytes squeezed into a band around mid-grey (Image.effect_noise can't be seeded)
+    spread = rng.uniform(20, 60) / 128
+    noise = Image.frombytes("L", (width, height), noise_rng.randbytes(width * height))
+    noise = noise.point(lambda value: round(128 + (value - 128) * spread))
+    flat = Image.new("L", (width, height), rng.randrange(256))
+    channels = [gradient, noise, flat]
+    rng.shuffle(channels)
+    img = Image.merge("RGB", channels)
+    if fmt == "GIF":
+        img = img.convert("P")
+    buffer = BytesIO()
+    img.save(buffer, fmt, **({"quality": 85} if fmt in ("JPEG", "WEBP") else {}))
+    return buffer.getvalue()
+
+def build_corpus(rng: random.Random, noise_rng: random.Random, count: int) -> list:
+    """[(filename, mime type, bytes, name, tags)] cycling through the size/format profiles"""
+    combos = [(w, h, fmt) for w, h, formats in IMAGE_PROFILES for fmt in formats]
+    corpus = []
+    for i in range(count):
+        width, height, fmt = combos[i % len(combos)]
+        words = rng.sample(VOCABULARY, 2)
+        corpus.append((
+            f"bench_{i}{EXTENSIONS[fmt]}",
+            MIME_TYPES[fmt],
+            synthetic_image(rng, noise_rng, width, height, fmt),
+            " ".join(words),
+            words,
+        ))
+    return corpus
+
+# --- Measurement ---
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def summarize(latencies: list, errors: int, elapsed: float, statuses: dict = None) -> dict:
+    ordered = sorted(latencies)
+    summary = {
+        "requests": len(latencies),
+        "errors": errors,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(ordered, 50) * 1000, 2),
+            "p95": round(percentile(ordered, 95) * 1000, 2),
+            "p99": round(percentile(ordered, 99) * 1000, 2),
+            "mean": round(sum(ordered) / len(ordered) * 1000, 2) if ordered else 0.0,
+            "max": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+        },
+    }
+    if statuses is not None:
+        summary["statuses"] = {str(code): n for code, n in sorted(statuses.items())}
+    return summary
+
+class Recorder:
+    """Latencies and status codes of one scenario"""
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+
+    async def request(self, session: aiohttp.ClientSession, method: str, url: str, **kwargs):
+        """Timed request; returns the parsed JSON body, or None on failure"""
+        started = time.perf_counter()
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                body = await response.read()
+                status = response.status
+        except aiohttp.ClientError:
+            self.errors += 1
+            self.statuses["error"] = self.statuses.get("error", 0) + 1
+            return None
+        self.latencies.append(time.perf_counter() - started)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status >= 400:
+            self.errors += 1
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+
+async def run_workers(concurrency: int, jobs: list, worker) -> float:
+    """Run worker(job) over jobs with at most `concurrency` in flight; returns elapsed seconds"""
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    async def drain():
+        while not queue.empty():
+            await worker(queue.get_nowait())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(drain() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+# --- Scenarios ---
+
+def client_ip(run_id: int, index: int) -> str:
+    """Synthetic client IP for the index-th upload; each IP stays under the quota"""
+    slot = index // UPLOADS_PER_IP
+    return f"10.{run_id}.{slot // 256}.{slot % 256}"
+
+async def bench_upload(session, target: str, corpus: list, concurrency: int, run_id: int, uploaders: set) -> dict:
+    recorder = Recorder()
+
+    async def upload(job):
+        index, (filename, mime_type, data, name, tags) = job
+        ip = client_ip(run_id, index)
+        form = aiohttp.FormData()
+        form.add_field("file", data, filename=filename, content_type=mime_type)
+        form.add_field("name", name)
+        form.add_field("tags", json.dumps(tags))
+        if await recorder.request(session, "POST", f"{target}/upload", data=form,
+                                  headers={"CF-Connecting-IP": ip}) is not None:
+            uploaders.add(ip)
+
+    elapsed = await run_workers(concurrency, list(enumerate(corpus)), upload)
+    result = summarize(recorder.latencies, recorder.errors, elapsed, recorder.statuses)
+    result["bytes_uploaded"] = sum(len(item[2]) for item in corpus)
+    return result
+
+def typing_session(rng: random.Random) -> list:
+    """
+    [(delay before sending, query)] for one simulated typist: the prefixes the
+    debounced search box would send, and how long after the previous one
+    """
+    query = " ".join(rng.sample(VOCABULARY, rng.choice([1, 1, 2])))
+    sent = []
+    waited = 0.0
+    for i in range(1, len(query) + 1):
+        if rng.random() < KEYSTROKE_PAUSE_CHANCE:
+            gap = rng.uniform(SEARCH_DEBOUNCE, SEARCH_DEBOUNCE * 3)
+        else:
+            gap = rng.expovariate(1 / KEYSTROKE_GAP_MEAN)
+        last = i == len(query)
+        if last or gap >= SEARCH_DEBOUNCE:
+            # The debounce fires SEARCH_DEBOUNCE after the keystroke
+            prefix = query[:i]
+            if prefix.strip():
+                sent.append((waited + SEARCH_DEBOUNCE, prefix))
+            waited = gap - SEARCH_DEBOUNCE if not last else 0.0
+        else:
+            waited += gap
+    return sent
+
+async def bench_search(session, target: str, rng: random.Random, concurrency: int, requests: int) -> dict:
+    recorder = Recorder()
+    sessions = []
+    planned = 0
+    while planned < requests:
+        keystrokes = typing_session(rng)
+        sessions.append(keystrokes)
+        planned += len(keystrokes)
+
+    async def typist(keystrokes):
+        for delay, query in keystrokes:
+            await asyncio.sleep(delay)
+            await recorder.request(session, "GET", f"{target}/search", params={"q": query})
+
+    elapsed = await run_workers(concurrency, sessions, typist)
+    result = summarize(recorder.latencies, recorder.errors, elapsed, recorder.statuses)
+    result["typing_sessions"] = len(sessions)
+    return result
+
+async def bench_get(session, url: str, concurrency: int, requests: int, headers: list = None) -> dict:
+    """The same GET `requests` times, cycling through headers if given"""
+    recorder = Recorder()
+    headers = headers or [None]
+
+    async def get(index):
+        await recorder.request(session, "GET", url, headers=headers[index % len(headers)])
+
+    elapsed = await run_workers(concurrency, list(range(requests)), get)
+    return summarize(recorder.latencies, recorder.errors, elapsed, recorder.statuses)
+
+def bench_process(corpus: list, repeat: int) -> dict:
+    """process_file over the corpus on local disk, with per-stage percentiles"""
+    work_dir = Path(tempfile.mkdtemp())
+    store = LocalStorage(work_dir, work_dir / ".staging")
+    store.init()
+    totals, stages, errors = [], {}, 0
+    started = time.perf_counter()
+    try:
+        for _ in range(repeat):
+            for filename, _, data, _, _ in corpus:
+                store.put_bytes(filename, data)
+                item_started = time.perf_counter()
+                try:
+                    processed = process_file(store, filename)
+                except (ValueError, OSError, Image.DecompressionBombError):
+                    errors += 1
+                    continue
+                totals.append(time.perf_counter() - item_started)
+                for stage, ms in processed["timings"].items():
+                    stages.setdefault(stage, []).append(ms / 1000)
+                store.delete(filename)
+                store.delete(processed["thumbnail"])
+                store.delete_prefix(rendition_prefix(filename))
+    finally:
+        shutil.rmtree(work_dir)
+    result = summarize(totals, errors, time.perf_counter() - started)
+    result["stages_ms"] = {stage: summarize(values, 0, 1)["latency_ms"] for stage, values in stages.items()}
+    return result
+
+# --- Report ---
+
+def compare(previous: dict, current: dict):
+    """Print p50/p95/p99 and throughput changes per scenario"""
+    print(f"\nCompared with {previous.get('meta', {}).get('started_at', 'previous run')}:")
+    for scenario, now in current["results"].items():
+        before = previous.get("results", {}).get(scenario)
+        if not before:
+            print(f"  {scenario:<11} (not in previous run)")
+            continue
+        changes = []
+        for metric in ("p50", "p95", "p99"):
+            old, new = before["latency_ms"][metric], now["latency_ms"][metric]
+            changes.append(f"{metric} {old:.1f}->{new:.1f}ms ({percent_change(old, new)})")
+        old, new = before["throughput_rps"], now["throughput_rps"]
+        changes.append(f"rps {old:.1f}->{new:.1f} ({percent_change(old, new)})")
+        print(f"  {scenario:<11} " + "  ".join(changes))
+
+def percent_change(old: float, new: float) -> str:
+    if not old:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+def print_report(report: dict):
+    for scenario, result in report["results"].items():
+        latency = result["latency_ms"]
+        print(
+            f"{scenario:<11} {result['requests']:>6} req  {result['errors']:>4} err  "
+            f"{result['throughput_rps']:>8.1f}/s  "
+            f"p50 {latency['p50']:>8.2f}ms  p95 {latency['p95']:>8.2f}ms  p99 {latency['p99']:>8.2f}ms"
+        )
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = {
+        "meta": {
+            "started_at": datetime.utcnow().isoformat() + "Z",
+            "target": args.target,
+            "scenarios": scenarios,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "uploads": args.uploads,
+            "seed": args.seed,
+            "run_id": args.run_id,
+        },
+        "results": {},
+    }
+    # The run id picks the pixel noise and the block of synthetic IPs, so the same
+    # arguments upload the same bytes from the same IPs
+    run_id = args.run_id
+    noise_rng = random.Random(f"{args.seed}:{run_id}")
+    corpus = build_corpus(rng, noise_rng, args.uploads) if {"upload", "process"} & set(scenarios) else []
+    uploaders = set()
+
+    timeout = aiohttp.ClientTimeout(total=300)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        for scenario in scenarios:
+            print(f"Running {scenario}...", file=sys.stderr)
+            if scenario == "upload":
+                result = await bench_upload(session, args.target, corpus, args.concurrency, run_id, uploaders)
+            elif scenario == "search":
+                result = await bench_search(session, args.target, rng, args.concurrency, args.requests)
+            elif scenario == "stats":
+                result = await bench_get(session, f"{args.target}/stats", args.concurrency, args.requests)
+            elif scenario == "my-uploads":
+                ips = sorted(uploaders) or [client_ip(run_id, 0)]
+                result = await bench_get(
+                    session, f"{args.target}/my-uploads", args.concurrency, args.requests,
+                    headers=[{"CF-Connecting-IP": ip} for ip in ips]
+                )
+            else:
+                result = await asyncio.to_thread(bench_process, corpus, args.process_repeat)
+            report["results"][scenario] = result
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the API and benchmark image processing")
+    parser.add_argument("--target", default=DEFAULT_TARGET, help="Base URL of the stack (default: %(default)s)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests (or typists) in flight")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per search/stats/my-uploads scenario")
+    parser.add_argument("--uploads", type=int, default=100, help="Synthetic images to upload and process")
+    parser.add_argument("--process-repeat", type=int, default=1, help="Passes over the corpus for the process scenario")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the corpus and typing patterns")
+    parser.add_argument("--run-id", type=int, default=1,
+                        help="1-254; picks the pixel noise and client IP block, change it to rerun without clearing earlier uploads")
+    parser.add_argument("--output", help="Write the report as JSON to this path")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+    if not 1 <= args.run_id <= 254:
+        parser.error("--run-id must be between 1 and 254")
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
@@ -0,0 +1,191 @@
+"""
+Optional Redis cache for the upload hot path.
+
+Keeps per-IP upload counts and known file hashes in the Redis instance Celery
+already uses, so duplicate uploads and over-quota rejections don't touch
+Postgres. Postgres stays the source of truth: entries are written through after
+each commit, invalidated on delete and rebuilt from the database on startup.
+Any Redis error is logged and treated as a cache miss.
+"""
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from typing import Optional
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+from celery_app import REDIS_URL
+from metrics import InstrumentedRedis
+from resources import REDIS_CONNECTION_BUDGET, worker_share
+from models import Image as ImageModel, UploadLimit
+
+logger = logging.getLogger(__name__)
+
+CACHE_ENABLED = os.getenv("REDIS_CACHE_ENABLED", "true").lower() == "true"
+QUOTA_CACHE_TTL = int(os.getenv("QUOTA_CACHE_TTL", "3600"))  # seconds
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", str(worker_share(REDIS_CONNECTION_BUDGET))))
+REBUILD_BATCH_SIZE = 1000
+
+QUOTA_KEY_PREFIX = "nerrf:quota:"
+HASHES_KEY = "nerrf:file_hashes"
+# Only adjusts a count that is cached; a missing one is filled from the database on the next read
+ADJUST_COUNT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+"""
+
+# file_hash -> deletion time, so a rebuild can drop hashes deleted after its snapshot
+DELETED_HASHES_KEY = "nerrf:file_hashes:deleted"
+DELETED_HASHES_WINDOW = 24 * 3600  # seconds; longer than any rebuild
+REBUILD_CLOCK_SKEW = 60  # seconds between API containers' clocks we tolerate
+
+# Applies the deletes logged since ARGV[1] to the scratch hash and swaps it in,
+# atomically so no delete can land between the two
+FINISH_REBUILD_SCRIPT = """
+local deleted = redis.call('ZRANGEBYSCORE', KEYS[3], ARGV[1], '+inf')
+for i = 1, #deleted, 1000 do
+    redis.call('HDEL', KEYS[1], unpack(deleted, i, math.min(i + 999, #deleted)))
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+else
+    redis.call('DEL', KEYS[2])
+end
+"""
+
+# Past the cap, commands fail fast with "Too many connections" and count as cache misses
+redis_client = InstrumentedRedis.from_url(REDIS_URL, decode_responses=True, max_connections=REDIS_MAX_CONNECTIONS)
+
+def pool_stats() -> dict:
+    """Connections of the shared client's pool, for metrics and /health"""
+    pool = redis_client.connection_pool
+    return {
+        "in_use": len(pool._in_use_connections),
+        "idle": len(pool._available_connections),
+        "max": REDIS_MAX_CONNECTIONS,
+    }
+
+async def warm_pool(connections: int):
+    """Open connections up front with concurrent PINGs"""
+    await asyncio.gather(*(redis_client.ping() for _ in range(min(connections, REDIS_MAX_CONNECTIONS))))
+
+async def get_cached_upload_count(ip_address: str) -> Optional[int]:
+    """Get the cached upload count for an IP, or None on a miss"""
+    if not CACHE_ENABLED:
+        return None
+    try:
+        count = await redis_client.get(f"{QUOTA_KEY_PREFIX}{ip_address}")
+        return int(count) if count is not None else None
+    except Exception as e:
+        logger.warning(f"Redis cache read failed: {e}")
+        return None
+
+async def set_cached_upload_count(ip_address: str, count: int):
+    """Cache an upload count read from the database, unless one is already cached and kept current by adjust_cached_upload_count"""
+    if not CACHE_ENABLED:
+        return
+    try:
+        await redis_client.set(f"{QUOTA_KEY_PREFIX}{ip_address}", count, ex=QUOTA_CACHE_TTL, nx=True)
+    except Exception as e:
+        logger.warning(f"Redis cache write failed: {e}")
+
+async def adjust_cached_upload_count(ip_address: str, delta: int):
+    """
+    Apply a committed change to an IP's cached upload count. Deltas commute, so
+    an upload and a delete committing concurrently can't leave a stale count the
+    way writing back an absolute count computed before the commit could.
+    """
+    if not CACHE_ENABLED or not delta:
+        return
+    try:
+        await redis_client.eval(ADJUST_COUNT_SCRIPT, 1, f"{QUOTA_KEY_PREFIX}{ip_address}", delta)
+    except Exception as e:
+        logger.warning(f"Redis cache write failed: {e}")
+
+async def get_cached_image(file_hash: str) -> Optional[dict]:
+    """Look up a known image by file hash, or None on a miss"""
+    if not CACHE_ENABLED:
+        return None
+    try:
+        entry = await redis_client.hget(HASHES_KEY, file_hash)
+        return json.loads(entry) if entry else None
+    except Exception as e:
+        logger.warning(f"Redis cache read failed: {e}")
+        return None
+
+def _image_entry(image_id: int, filename: str, uploaded_at) -> str:
+    return json.dumps({
+        "id": image_id,
+        "filename": filename,
+        "uploaded_at": uploaded_at.isoformat() if uploaded_at else None
+    })
+
+async def cache_image(file_hash: str, image_id: int, filename: str, uploaded_at):
+    """Write through a committed image so later uploads of it are caught as duplicates"""
+    if not CACHE_ENABLED:
+        return
+    try:
+        await redis_client.hset(HASHES_KEY, file_hash, _image_entry(image_id, filename, uploaded_at))
+    except Exception as e:
+        logger.warning(f"Redis cache write failed: {e}")
+
+async def invalidate_image(file_hash: str):
+    """Forget a deleted image"""
+    if not CACHE_ENABLED:
+        return
+    try:
+        now = time.time()
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.zadd(DELETED_HASHES_KEY, {file_hash: now})
+            pipe.zremrangebyscore(DELETED_HASHES_KEY, "-inf", now - DELETED_HASHES_WINDOW)
+            pipe.hdel(HASHES_KEY, file_hash)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Redis cache invalidation failed: {e}")
+
+async def rebuild_cache(db: AsyncSession):
+    """
+    Rebuild the cache from Postgres. File hashes are loaded into a scratch key
+    and swapped in with RENAME so readers never see a half-built set. Images
+    deleted while it loads are removed from the scratch key before the swap.
+    """
+    if not CACHE_ENABLED:
+        return
+    try:
+        scratch_key = f"{HASHES_KEY}:rebuild:{uuid.uuid4().hex}"
+        started = time.time() - REBUILD_CLOCK_SKEW
+        total_images = 0
+        result = await db.stream(
+            select(ImageModel.file_hash, ImageModel.id, ImageModel.filename, ImageModel.uploaded_at)
+            .execution_options(yield_per=REBUILD_BATCH_SIZE)
+        )
+        async for rows in result.partitions():
+            mapping = {row.file_hash: _image_entry(row.id, row.filename, row.uploaded_at) for row in rows}
+            await redis_client.hset(scratch_key, mapping=mapping)
+            total_images += len(rows)
+
+        await redis_client.eval(FINISH_REBUILD_SCRIPT, 3, scratch_key, HASHES_KEY, DELETED_HASHES_KEY, started)
+
+        total_ips = 0
+        result = await db.stream(
+            select(UploadLimit.ip_address, UploadLimit.upload_count)
+            .execution_options(yield_per=REBUILD_BATCH_SIZE)
+        )
+        async for rows in result.partitions():
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for row in rows:
+                    pipe.set(f"{QUOTA_KEY_PREFIX}{row.ip_address}", row.upload_count or 0, ex=QUOTA_CACHE_TTL)
+                await pipe.execute()
+            total_ips += len(rows)
+
+        logger.info(f"Rebuilt Redis cache: {total_images} file hashes, {total_ips} upload counters")
+    except Exception as e:
+        logger.error(f"Failed to rebuild Redis cache: {e}")
+
+async def close_cache():
+    """Close Redis connection"""
+    await redis_client.close()
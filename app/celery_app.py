@@ -1,7 +1,15 @@
 from celery import Celery
 import os
 
+import metrics  # noqa: F401 - connects the task timing signal handlers
+
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+STATS_RECONCILE_INTERVAL = int(os.getenv("STATS_RECONCILE_INTERVAL", "3600"))  # seconds
+RESUMABLE_CLEANUP_INTERVAL = int(os.getenv("RESUMABLE_CLEANUP_INTERVAL", "3600"))  # seconds
+
+# "single": one process_image task per upload; "batch": process_pending_images sweeps pending uploads
+PROCESSING_MODE = os.getenv("PROCESSING_MODE", "single")
+PROCESSING_BATCH_INTERVAL = float(os.getenv("PROCESSING_BATCH_INTERVAL", "2.0"))  # seconds
 
 celery_app = Celery(
     "image_tasks",
@@ -20,3 +28,20 @@ celery_app.conf.update(
     worker_prefetch_multiplier=1,
     broker_connection_retry_on_startup=True,
 )
+
+celery_app.conf.beat_schedule = {
+    'reconcile-stats': {
+        'task': 'tasks.reconcile_stats',
+        'schedule': STATS_RECONCILE_INTERVAL,
+    },
+    'expire-resumable-uploads': {
+        'task': 'tasks.expire_resumable_uploads',
+        'schedule': RESUMABLE_CLEANUP_INTERVAL,
+    },
+}
+
+if PROCESSING_MODE == "batch":
+    celery_app.conf.beat_schedule['process-pending-images'] = {
+        'task': 'tasks.process_pending_images',
+        'schedule': PROCESSING_BATCH_INTERVAL,
+    }
@@ -0,0 +1,85 @@
+"""
+Conditional and compressed JSON responses (/stats, /my-uploads, /search).
+
+Responses carry a weak ETag, since the bytes differ per Content-Encoding, and
+Cache-Control: no-cache, so browsers revalidate on every poll with
+If-None-Match. Bodies of COMPRESSION_MIN_SIZE bytes or more are compressed
+with brotli or gzip, whichever the client prefers.
+"""
+from typing import Optional
+import gzip
+import hashlib
+import json
+import os
+
+import brotli
+from fastapi import Request, Response
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))  # bytes
+BROTLI_QUALITY = 4  # Smaller than gzip -6 at similar speed; 11 (the default) is far too slow per request
+GZIP_LEVEL = 6
+
+ENCODINGS = ("br", "gzip")  # Preferred first on equal q-values
+
+def json_etag(*parts) -> str:
+    """Weak ETag from everything a response depends on"""
+    digest = hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()[:32]
+    return f'W/"{digest}"'
+
+def body_etag(body: bytes) -> str:
+    """Weak ETag from a rendered body"""
+    return f'W/"{hashlib.sha1(body).hexdigest()[:32]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Whether an If-None-Match header covers etag (weak comparison, as for GET)"""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def render_json(content) -> bytes:
+    """The same bytes JSONResponse would send"""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def preferred_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """br or gzip per the Accept-Encoding q-values, or None"""
+    weights = {}
+    for item in (accept_encoding or "").lower().split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding.strip()] = q
+    candidates = [(weights.get(coding, weights.get("*", 0.0)), -rank, coding) for rank, coding in enumerate(ENCODINGS)]
+    q, _, coding = max(candidates)
+    return coding if q > 0 else None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+def cache_headers(etag: Optional[str]) -> dict:
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag:
+        headers["ETag"] = etag
+    return headers
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag))
+
+def json_response(request: Request, body: bytes, etag: Optional[str] = None) -> Response:
+    """A rendered JSON body with its ETag, compressed if it's large enough and the client accepts it"""
+    headers = cache_headers(etag)
+    if len(body) >= COMPRESSION_MIN_SIZE:
+        encoding = preferred_encoding(request.headers.get("Accept-Encoding"))
+        if encoding:
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
@@ -1,112 +1,216 @@
-from elasticsearch import Elasticsearch, AsyncElasticsearch
+from elasticsearch import BadRequestError
+from datetime import datetime
+from typing import Optional
+import asyncio
 import os
 import logging
 
+from es_indexer import BulkIndexer
+from search_cache import search_cache
+from pagination import encode_cursor, decode_cursor
+from metrics import InstrumentedAsyncElasticsearch
+from resources import ES_CONNECTION_BUDGET, worker_share
+from storage import url_for
+
 logger = logging.getLogger(__name__)
 
 ELASTICSEARCH_URL = os.getenv("ELASTICSEARCH_URL", "http://localhost:9200")
+ES_CONNECTIONS_PER_NODE = int(os.getenv("ES_CONNECTIONS_PER_NODE", str(worker_share(ES_CONNECTION_BUDGET))))
+ES_REQUEST_TIMEOUT = float(os.getenv("ES_REQUEST_TIMEOUT", "10"))  # seconds
 
 # Create async Elasticsearch client
-es_client = AsyncElasticsearch([ELASTICSEARCH_URL])
+es_client = InstrumentedAsyncElasticsearch(
+    [ELASTICSEARCH_URL],
+    connections_per_node=ES_CONNECTIONS_PER_NODE,
+    request_timeout=ES_REQUEST_TIMEOUT
+)
 
 INDEX_NAME = "images"
 
+# The live index is an images_v<timestamp> index behind the images alias. The
+# index template gives every index matching INDEX_PATTERN the settings and
+# mapping, so scripts/cleanup.sh can recreate one with a bare PUT
+INDEX_PATTERN = f"{INDEX_NAME}_v*"
+INDEX_ALIASES = {INDEX_NAME: {"is_write_index": True}}
+
+# Matches the default index.refresh_interval: flushed writes are searchable after this
+INDEX_REFRESH_INTERVAL = 1.0  # seconds
+
+# Index settings and mapping, shared by init_elasticsearch and the reindex command
+INDEX_BODY = {
+    "settings": {
+        "analysis": {
+            "analyzer": {
+                "autocomplete": {
+                    "type": "custom",
+                    "tokenizer": "standard",
+                    "filter": ["lowercase", "autocomplete_filter"]
+                },
+                "autocomplete_search": {
+                    "type": "custom",
+                    "tokenizer": "standard",
+                    "filter": ["lowercase"]
+                }
+            },
+            "filter": {
+                "autocomplete_filter": {
+                    "type": "edge_ngram",
+                    "min_gram": 2,
+                    "max_gram": 20
+                }
+            }
+        }
+    },
+    "mappings": {
+        "properties": {
+            "image_id": {"type": "integer"},
+            "name": {
+                "type": "text",
+                "analyzer": "autocomplete",
+                "search_analyzer": "autocomplete_search",
+                "fields": {
+                    "keyword": {"type": "keyword"}
+                }
+            },
+            "description": {
+                "type": "text",
+                "analyzer": "autocomplete",
+                "search_analyzer": "autocomplete_search"
+            },
+            "tags": {"type": "keyword"},
+            "url": {"type": "keyword"},
+            "thumbnail_url": {"type": "keyword"},
+            "file_hash": {"type": "keyword"},
+            "uploaded_at": {"type": "date"},
+            # Filled in by processing so clients can lay out results by aspect ratio
+            "width": {"type": "integer"},
+            "height": {"type": "integer"},
+            "aspect_ratio": {"type": "float"},
+            "format": {"type": "keyword"},
+            # Stored for the frontend's srcset, not searched
+            "renditions": {"type": "object", "enabled": False},
+            # Prefix-only FST lookups for /suggest, fed from name and tags
+            "suggest": {
+                "type": "completion",
+                "analyzer": "simple",
+                "preserve_separators": True,
+                "preserve_position_increments": True,
+                "max_input_length": 50
+            }
+        }
+    }
+}
+
+def _invalidate_search_cache_after_refresh():
+    """Invalidate cached search results once flushed writes become visible"""
+    loop = asyncio.get_running_loop()
+    loop.call_later(INDEX_REFRESH_INTERVAL, lambda: loop.create_task(search_cache.invalidate()))
+
+# Background _bulk queue for all writes from the request path
+bulk_indexer = BulkIndexer(es_client, on_flush=_invalidate_search_cache_after_refresh)
+
+def versioned_index_name() -> str:
+    return f"{INDEX_NAME}_v{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+
 async def init_elasticsearch():
-    """Initialize Elasticsearch index with mapping"""
+    """Install the index template and create the index and alias if neither exists"""
     try:
-        # Check if index exists
+        await es_client.indices.put_index_template(
+            name=INDEX_NAME,
+            index_patterns=[INDEX_PATTERN],
+            template=INDEX_BODY
+        )
+
+        # True for the alias, or for a concrete index from before the first reindex
         exists = await es_client.indices.exists(index=INDEX_NAME)
         
         if not exists:
-            # Create index with mapping
-            await es_client.indices.create(
+            index = versioned_index_name()
+            try:
+                await es_client.indices.create(index=index, aliases=INDEX_ALIASES)
+                logger.info(f"Created Elasticsearch index {index} with alias {INDEX_NAME}")
+            except BadRequestError:
+                # Another API worker got there first
+                if not await es_client.indices.exists(index=INDEX_NAME):
+                    raise
+        else:
+            # Add any fields introduced since the index was created (e.g. suggest);
+            # existing documents pick them up on the next reindex
+            await es_client.indices.put_mapping(
                 index=INDEX_NAME,
-                body={
-                    "settings": {
-                        "analysis": {
-                            "analyzer": {
-                                "autocomplete": {
-                                    "type": "custom",
-                                    "tokenizer": "standard",
-                                    "filter": ["lowercase", "autocomplete_filter"]
-                                },
-                                "autocomplete_search": {
-                                    "type": "custom",
-                                    "tokenizer": "standard",
-                                    "filter": ["lowercase"]
-                                }
-                            },
-                            "filter": {
-                                "autocomplete_filter": {
-                                    "type": "edge_ngram",
-                                    "min_gram": 2,
-                                    "max_gram": 20
-                                }
-                            }
-                        }
-                    },
-                    "mappings": {
-                        "properties": {
-                            "image_id": {"type": "integer"},
-                            "name": {
-                                "type": "text",
-                                "analyzer": "autocomplete",
-                                "search_analyzer": "autocomplete_search",
-                                "fields": {
-                                    "keyword": {"type": "keyword"}
-                                }
-                            },
-                            "description": {
-                                "type": "text",
-                                "analyzer": "autocomplete",
-                                "search_analyzer": "autocomplete_search"
-                            },
-                            "tags": {"type": "keyword"},
-                            "url": {"type": "keyword"},
-                            "thumbnail_url": {"type": "keyword"},
-                            "file_hash": {"type": "keyword"},
-                            "uploaded_at": {"type": "date"}
-                        }
-                    }
-                }
+                properties=INDEX_BODY["mappings"]["properties"]
             )
-            logger.info(f"Created Elasticsearch index: {INDEX_NAME}")
-        else:
             logger.info(f"Elasticsearch index {INDEX_NAME} already exists")
     except Exception as e:
         logger.error(f"Failed to initialize Elasticsearch: {e}")
 
+def build_image_document(image_id: int, name: str, description: str, tags: list, url: str, file_hash: str, uploaded_at, processing: Optional[dict] = None) -> dict:
+    """Build the Elasticsearch document for an image"""
+    # Generate thumbnail URL from main URL
+    # /images/filename.png -> /images/thumbs/filename.png
+    thumbnail_url = url.replace('/images/', '/images/thumbs/')
+    
+    doc = {
+        "image_id": image_id,
+        "name": name,
+        "description": description,
+        "tags": tags,
+        "url": url,
+        "thumbnail_url": thumbnail_url,
+        "file_hash": file_hash,
+        "uploaded_at": uploaded_at.isoformat() if uploaded_at else None,
+        "suggest": {"input": [text for text in [name, *(tags or [])] if text]}
+    }
+    # Processing results (dimensions, renditions) are only known after the worker
+    # runs; leave them out rather than overwrite what it may already have written
+    if processing:
+        doc.update(processing)
+    return doc
+
+def processing_document_fields(width: int, height: int, format: str, thumbnail_path: str, renditions: list) -> dict:
+    """Search document fields that only exist once an image has been processed"""
+    fields = {
+        "width": width,
+        "height": height,
+        "aspect_ratio": round(width / height, 4) if width and height else None,
+        "format": format,
+        "renditions": renditions or []
+    }
+    if thumbnail_path:
+        fields["thumbnail_url"] = url_for(thumbnail_path)
+    return fields
+
 async def index_image(image_id: int, name: str, description: str, tags: list, url: str, file_hash: str, uploaded_at):
-    """Index an image in Elasticsearch"""
+    """Queue an image for indexing in Elasticsearch"""
     try:
-        # Generate thumbnail URL from main URL
-        # /images/filename.png -> /images/thumbs/filename.png
-        thumbnail_url = url.replace('/images/', '/images/thumbs/')
-        
-        doc = {
-            "image_id": image_id,
-            "name": name,
-            "description": description,
-            "tags": tags,
-            "url": url,
-            "thumbnail_url": thumbnail_url,
-            "file_hash": file_hash,
-            "uploaded_at": uploaded_at.isoformat() if uploaded_at else None
-        }
-        
-        await es_client.index(
-            index=INDEX_NAME,
-            id=str(image_id),
-            document=doc
-        )
-        logger.info(f"Indexed image {image_id} in Elasticsearch")
+        doc = build_image_document(image_id, name, description, tags, url, file_hash, uploaded_at)
+        # Upsert so fields the Celery worker may have merged in first survive
+        bulk_indexer.enqueue_update(INDEX_NAME, str(image_id), doc, upsert=True)
+        logger.info(f"Queued image {image_id} for indexing")
         return True
     except Exception as e:
-        logger.error(f"Failed to index image in Elasticsearch: {e}")
+        logger.error(f"Failed to queue image for indexing: {e}")
         return False
 
-async def search_images(query: str, size: int = 50):
-    """Search images in Elasticsearch"""
+# Fields a search caller may project with `fields`
+SEARCHABLE_SOURCE_FIELDS = {
+    "image_id", "name", "description", "tags", "url", "thumbnail_url", "file_hash", "uploaded_at", "renditions",
+    "width", "height", "aspect_ratio", "format"
+}
+
+async def search_images(
+    query: str,
+    size: int = 50,
+    cursor: Optional[str] = None,
+    fields: Optional[list] = None,
+    track_total_hits: bool = False
+) -> dict:
+    """
+    Search images in Elasticsearch, one page at a time.
+    Returns {"results", "next_cursor", "total"}; total is None unless track_total_hits.
+    Raises ValueError for a malformed cursor.
+    """
+    search_after = decode_cursor(cursor, 3) if cursor else None
     try:
         # Build search query
         search_body = {
@@ -120,37 +224,94 @@ async def search_images(query: str, size: int = 50):
             "size": size,
             "sort": [
                 {"_score": {"order": "desc"}},
-                {"uploaded_at": {"order": "desc"}}
-            ]
+                {"uploaded_at": {"order": "desc"}},
+                {"image_id": {"order": "desc"}}  # Tiebreaker so search_after pages are stable
+            ],
+            "track_total_hits": track_total_hits
         }
+        if search_after:
+            search_body["search_after"] = search_after
+        if fields:
+            search_body["_source"] = fields
+        else:
+            search_body["_source"] = {"excludes": ["suggest"]}
         
         response = await es_client.search(
             index=INDEX_NAME,
             body=search_body
         )
         
-        results = []
-        for hit in response['hits']['hits']:
-            results.append(hit['_source'])
+        hits = response['hits']['hits']
+        results = [hit['_source'] for hit in hits]
+        next_cursor = encode_cursor(hits[-1]['sort']) if len(hits) == size else None
+        total = response['hits']['total']['value'] if track_total_hits else None
         
-        return results
+        return {"results": results, "next_cursor": next_cursor, "total": total}
     except Exception as e:
         logger.error(f"Failed to search images in Elasticsearch: {e}")
-        return []
+        # Flagged so callers don't cache an outage as an empty result
+        return {"results": [], "next_cursor": None, "total": 0 if track_total_hits else None, "failed": True}
 
-async def delete_image(image_id: int):
-    """Delete an image from Elasticsearch"""
+async def suggest_images(prefix: str, size: int = 5) -> list:
+    """Get top-N name/tag completions for a prefix from the completion suggester"""
     try:
-        await es_client.delete(
+        response = await es_client.search(
             index=INDEX_NAME,
-            id=str(image_id)
+            body={
+                "_source": ["image_id", "name", "thumbnail_url"],
+                "suggest": {
+                    "image-suggest": {
+                        "prefix": prefix,
+                        "completion": {
+                            "field": "suggest",
+                            "size": size,
+                            "skip_duplicates": True
+                        }
+                    }
+                }
+            }
         )
-        logger.info(f"Deleted image {image_id} from Elasticsearch")
+        
+        return [
+            {"text": option["text"], **option["_source"]}
+            for option in response["suggest"]["image-suggest"][0]["options"]
+        ]
+    except Exception as e:
+        logger.error(f"Failed to get suggestions from Elasticsearch: {e}")
+        return []
+
+async def delete_image(image_id: int):
+    """Queue an image for deletion from Elasticsearch"""
+    try:
+        bulk_indexer.enqueue_delete(INDEX_NAME, str(image_id))
+        logger.info(f"Queued image {image_id} for deletion from Elasticsearch")
         return True
     except Exception as e:
-        logger.error(f"Failed to delete image from Elasticsearch: {e}")
+        logger.error(f"Failed to queue image deletion: {e}")
         return False
 
+def pool_stats() -> dict:
+    """Connections held by the client's HTTP sessions, for metrics and /health"""
+    in_use = idle = 0
+    nodes = es_client.transport.node_pool.all()
+    for node in nodes:
+        session = getattr(node, "session", None)
+        if session is None:
+            continue  # No request has gone to this node yet
+        connector = session.connector
+        in_use += len(connector._acquired)
+        idle += sum(len(conns) for conns in connector._conns.values())
+    return {"in_use": in_use, "idle": idle, "max": ES_CONNECTIONS_PER_NODE * len(nodes)}
+
+async def warm_pool(connections: int):
+    """Open connections up front with concurrent pings"""
+    await asyncio.gather(*(es_client.ping() for _ in range(min(connections, ES_CONNECTIONS_PER_NODE))))
+
+def start_indexer():
+    """Start the background bulk indexer"""
+    bulk_indexer.start()
+
 async def close_elasticsearch():
-    """Close Elasticsearch connection"""
+    """Flush pending writes and close Elasticsearch connection"""
+    await bulk_indexer.stop()
     await es_client.close()
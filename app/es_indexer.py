@@ -0,0 +1,175 @@
+"""
+Background bulk indexer for Elasticsearch.
+
+Request handlers enqueue index/delete actions and return immediately. A single
+asyncio task drains the queue and sends the actions with the _bulk API, flushing
+whenever a batch fills up or the flush interval elapses. Items that fail with a
+retryable status are resent with backoff before the next batch is taken, so a
+later action for the same document can't overtake them.
+"""
+from elasticsearch import AsyncElasticsearch
+from typing import Callable, Optional
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+ES_BULK_MAX_BATCH = int(os.getenv("ES_BULK_MAX_BATCH", "500"))
+ES_BULK_FLUSH_INTERVAL = float(os.getenv("ES_BULK_FLUSH_INTERVAL", "1.0"))  # seconds
+ES_BULK_MAX_RETRIES = int(os.getenv("ES_BULK_MAX_RETRIES", "3"))
+
+# Bulk item statuses worth retrying; anything else (e.g. mapping errors) is dropped
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+
+_STOP = object()  # Queued by stop() after everything already enqueued
+
+class BulkIndexer:
+    """Buffers Elasticsearch actions and flushes them with the _bulk API"""
+
+    def __init__(
+        self,
+        client: AsyncElasticsearch,
+        max_batch: int = ES_BULK_MAX_BATCH,
+        flush_interval: float = ES_BULK_FLUSH_INTERVAL,
+        max_retries: int = ES_BULK_MAX_RETRIES,
+        on_flush: Optional[Callable[[], None]] = None,
+    ):
+        self.client = client
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.on_flush = on_flush  # Called after a flush that wrote something
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self.indexed = 0
+        self.failed = 0
+        self.retried = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "indexed": self.indexed,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+    def enqueue_index(self, index: str, doc_id: str, document: dict):
+        """Queue a full document write"""
+        self._queue.put_nowait(({"index": {"_index": index, "_id": doc_id}}, document))
+
+    def enqueue_update(self, index: str, doc_id: str, fields: dict, upsert: bool = False):
+        """Queue a partial document update; with upsert the fields create the document if it's missing"""
+        source = {"doc": fields, "doc_as_upsert": True} if upsert else {"doc": fields}
+        self._queue.put_nowait(({"update": {"_index": index, "_id": doc_id}}, source))
+
+    def enqueue_delete(self, index: str, doc_id: str):
+        """Queue a delete; it goes through the same queue so it can't overtake a pending write"""
+        self._queue.put_nowait(({"delete": {"_index": index, "_id": doc_id}}, None))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush whatever is still queued, including pending retries, and stop the background task"""
+        if self._task is not None:
+            self._queue.put_nowait(_STOP)
+            await self._task
+            self._task = None
+        while not self._queue.empty():
+            await self._flush(self._drain(self.max_batch))
+
+    def _drain(self, limit: int) -> list:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            # Block until there is work, then gather more until the window closes
+            entry = await self._queue.get()
+            if entry is _STOP:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if entry is _STOP:
+                    await self._flush(batch)
+                    return
+                batch.append(entry)
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        """Send a batch, resending retryable failures with backoff until they succeed or run out of retries"""
+        attempt = 0
+        while batch:
+            retry = await self._send(batch)
+            if not retry:
+                return
+            if attempt >= self.max_retries:
+                self.failed += len(retry)
+                logger.error(f"Giving up on {len(retry)} Elasticsearch actions after {attempt} retries")
+                return
+            self.retried += len(retry)
+            await asyncio.sleep(self.flush_interval * (2 ** attempt))
+            attempt += 1
+            batch = retry
+
+    async def _send(self, batch: list) -> list:
+        """One _bulk request; returns the entries to resend, in their original order"""
+        operations = []
+        for action, source in batch:
+            operations.append(action)
+            if source is not None:
+                operations.append(source)
+
+        try:
+            response = await self.client.bulk(operations=operations)
+        except Exception as e:
+            logger.error(f"Bulk request to Elasticsearch failed: {e}")
+            return batch
+
+        self._notify_flush()
+        if not response.get("errors"):
+            self.indexed += len(batch)
+            return []
+
+        retry = []
+        retry_ids = set()
+        for item, entry in zip(response["items"], batch):
+            op, result = next(iter(item.items()))
+            status = result.get("status", 500)
+            doc_id = next(iter(entry[0].values()))["_id"]
+            if doc_id in retry_ids:
+                # An earlier action on this document is being resent; resend this one after it
+                retry.append(entry)
+            elif status < 300 or (op == "delete" and status == 404):
+                self.indexed += 1
+            elif status in RETRYABLE_STATUSES:
+                retry.append(entry)
+                retry_ids.add(doc_id)
+            else:
+                self.failed += 1
+                logger.error(f"Elasticsearch {op} failed for {result.get('_id')}: {result.get('error')}")
+        return retry
+
+    def _notify_flush(self):
+        if self.on_flush is not None:
+            try:
+                self.on_flush()
+            except Exception as e:
+                logger.error(f"Bulk indexer flush callback failed: {e}")
@@ -0,0 +1,226 @@
+"""
+Image processing engine for the Celery pipeline.
+
+Each upload is opened once. Format and dimensions come from the header and are
+checked against a pixel budget before anything is decoded; the pixel data is
+then decoded a single time (JPEGs in draft mode, straight at a reduced scale)
+and downscaled to a configurable set of widths, largest first, each rendition
+resized from the previous one. Renditions are encoded as WebP by default, with
+optional progressive JPEG and AVIF (AVIF needs the pillow-avif-plugin package).
+A 64-bit perceptual hash (dHash) is taken from the same decode for near-duplicate
+detection. Every stage is timed.
+
+Run directly to benchmark a directory of images:
+    python image_processing.py /path/to/corpus
+"""
+from PIL import Image
+from pathlib import Path
+from typing import Callable, Optional
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import pillow_avif  # noqa: F401  Registers the AVIF encoder with Pillow
+except ImportError:
+    pass
+
+from storage import LocalStorage, thumbnail_key, rendition_key, url_for
+
+logger = logging.getLogger(__name__)
+
+RENDITION_WIDTHS = sorted(
+    {int(w) for w in os.getenv("RENDITION_WIDTHS", "200,640,1280").split(",") if w.strip()},
+    reverse=True
+)
+RENDITION_FORMATS = [f.strip().lower() for f in os.getenv("RENDITION_FORMATS", "webp").split(",") if f.strip()]
+THUMBNAIL_SIZE = (200, 200)
+DHASH_SIZE = 8  # 8x8 gradient comparisons = 64-bit hash
+
+# Decompression-bomb budget, checked from the header before decoding
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(50_000_000)))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+ALLOWED_FORMATS = {"JPEG", "PNG", "GIF", "WEBP", "BMP"}
+
+# Pillow format name, file extension and encoder options per output format (renditions and transforms)
+ENCODERS = {
+    "webp": ("WEBP", "webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "jpg", {"quality": 82, "optimize": True, "progressive": True}),
+    "avif": ("AVIF", "avif", {"quality": 60}),
+    "png": ("PNG", "png", {"optimize": True}),
+}
+
+def available_formats() -> list:
+    """Configured rendition formats that this Pillow build can encode"""
+    Image.init()
+    formats = []
+    for fmt in RENDITION_FORMATS:
+        encoder = ENCODERS.get(fmt)
+        if encoder is None or encoder[0] not in Image.SAVE:
+            logger.warning(f"Skipping rendition format {fmt}: no encoder available")
+            continue
+        formats.append(fmt)
+    return formats
+
+def prepare_mode(img: Image.Image, fmt: str) -> Image.Image:
+    """Convert to a mode the target encoder accepts"""
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    if fmt == "jpeg":
+        return img if img.mode == "RGB" else img.convert("RGB")
+    target = "RGBA" if has_alpha else "RGB"
+    return img if img.mode == target else img.convert(target)
+
+def generate_renditions(img: Image.Image, original_size: tuple, store, key: str) -> list:
+    """
+    Write every configured width/format rendition of an already-decoded image.
+    `img` may be a draft-mode decode smaller than `original_size`; widths at or
+    above the original width collapse into a single original-width rendition.
+    Returns [{"width", "height", "format", "url"}], largest first.
+    """
+    formats = available_formats()
+    if not formats:
+        return []
+
+    original_width, original_height = original_size
+    widths = sorted({min(w, original_width) for w in RENDITION_WIDTHS}, reverse=True)
+
+    renditions = []
+    current = img
+    for width in widths:
+        height = max(1, round(original_height * width / original_width))
+        if current.size != (width, height):
+            # reducing_gap lets Pillow use the fast integer reduce() before resampling
+            current = current.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+
+        for fmt in formats:
+            pil_format, ext, options = ENCODERS[fmt]
+            out_key = rendition_key(key, width, ext)
+            buffer = io.BytesIO()
+            prepare_mode(current, fmt).save(buffer, pil_format, **options)
+            store.put_bytes(out_key, buffer.getvalue())
+            renditions.append({
+                "width": width,
+                "height": height,
+                "format": fmt,
+                "url": url_for(out_key)
+            })
+
+    return renditions
+
+def perceptual_hash(img: Image.Image) -> int:
+    """
+    Difference hash: shrink to (DHASH_SIZE + 1) x DHASH_SIZE grayscale and set one
+    bit per pixel that is brighter than its right-hand neighbour. Re-encoded and
+    resized copies of an image land within a few bits of each other.
+    """
+    small = img.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR, reducing_gap=2.0)
+    pixels = small.tobytes()
+    phash = 0
+    for row in range(DHASH_SIZE):
+        offset = row * (DHASH_SIZE + 1)
+        for col in range(DHASH_SIZE):
+            phash = (phash << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return phash
+
+def process_file(store, key: str, on_stage: Optional[Callable[[str], None]] = None) -> dict:
+    """
+    Validate, decode once and write renditions plus a thumbnail for one stored upload.
+    `store` is a storage backend; the original is fetched from it by key.
+    Raises ValueError for unsupported formats or images over the pixel budget,
+    and OSError for corrupt or truncated data.
+    Returns {"width", "height", "format", "phash", "thumbnail", "renditions", "timings"},
+    with the thumbnail's storage key and per-stage timings in milliseconds.
+    """
+    timings = {}
+    started = time.perf_counter()
+
+    def mark(stage: str):
+        nonlocal started
+        now = time.perf_counter()
+        timings[stage] = round((now - started) * 1000, 2)
+        started = now
+
+    def report(status: str):
+        if on_stage is not None:
+            on_stage(status)
+
+    report('Validating image...')
+    with store.fetch(key) as source, Image.open(source) as img:
+        # Header only: nothing has been decoded yet
+        width, height = img.size
+        format_name = img.format
+        if format_name not in ALLOWED_FORMATS:
+            raise ValueError(f"Unsupported image format: {format_name}")
+        if width * height > MAX_IMAGE_PIXELS:
+            raise ValueError(f"Image too large: {width}x{height} exceeds {MAX_IMAGE_PIXELS} pixels")
+        mark('open')
+
+        # Decode once; JPEGs decode straight at the smallest scale covering the largest rendition.
+        # A corrupt or truncated file fails here, which replaces a separate verify() pass.
+        largest = min(max(RENDITION_WIDTHS), width)
+        img.draft(None, (largest, max(1, round(height * largest / width))))
+        img.load()
+        mark('decode')
+
+        phash = perceptual_hash(img)
+        mark('phash')
+
+        report('Creating renditions...')
+        renditions = generate_renditions(img, (width, height), store, key)
+        mark('renditions')
+
+        report('Creating thumbnail...')
+        thumb_key = thumbnail_key(key)
+        img.thumbnail(THUMBNAIL_SIZE, reducing_gap=2.0)
+        buffer = io.BytesIO()
+        img.save(buffer, format_name)
+        store.put_bytes(thumb_key, buffer.getvalue())
+        mark('thumbnail')
+
+    return {
+        'width': width,
+        'height': height,
+        'format': format_name,
+        'phash': phash,
+        'thumbnail': thumb_key,
+        'renditions': renditions,
+        'timings': timings
+    }
+
+def benchmark(corpus_dir: str):
+    """Process every image in a directory (on copies) and print per-stage totals"""
+    files = sorted(p for p in Path(corpus_dir).iterdir() if p.is_file())
+    totals = {}
+    processed = 0
+    work_dir = Path(tempfile.mkdtemp())
+    store = LocalStorage(work_dir)
+    started = time.perf_counter()
+    try:
+        for path in files:
+            shutil.copyfile(path, store.path(path.name))
+            try:
+                result = process_file(store, path.name)
+            except (ValueError, OSError, Image.DecompressionBombError) as e:
+                print(f"skip {path.name}: {e}")
+                continue
+            processed += 1
+            for stage, ms in result['timings'].items():
+                totals[stage] = totals.get(stage, 0) + ms
+    finally:
+        shutil.rmtree(work_dir)
+
+    elapsed = time.perf_counter() - started
+    print(f"{processed} images in {elapsed:.2f}s ({processed / max(elapsed, 1e-9):.1f} images/sec)")
+    for stage, ms in totals.items():
+        print(f"  {stage:<12} total {ms:10.1f} ms   mean {ms / max(processed, 1):8.2f} ms")
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python image_processing.py /path/to/corpus")
+        sys.exit(1)
+    benchmark(sys.argv[1])
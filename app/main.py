@@ -1,24 +1,113 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Request, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Request, Form, Query, Header
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse, Response, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, func, literal, true, tuple_, any_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from celery import group
 from celery.result import AsyncResult
+import asyncio
 import hashlib
 import aiofiles
 from pathlib import Path
 import os
 from datetime import datetime
 import mimetypes
+import time
 import json
+import uuid
+from typing import Optional, List
 
-from database import get_db, init_db
+from database import get_db, init_db, async_session
 from models import Image as ImageModel, UploadLimit
+from pagination import encode_cursor, decode_cursor
+from storage import storage, content_key, thumbnail_key, url_for, delete_image_files, S3_PRESIGN_EXPIRES
+from celery_app import PROCESSING_MODE
+from quota import (
+    MAX_UPLOADS_PER_IP, reserve_upload_slot, reserve_upload_slots, release_upload_slot, get_upload_count
+)
+from cache import (
+    rebuild_cache, get_cached_upload_count, set_cached_upload_count, adjust_cached_upload_count,
+    get_cached_image, cache_image, invalidate_image, close_cache
+)
+from stats import apply_stats_delta, get_catalog_stats, init_stats
+from resumable import (
+    RESUMABLE_SESSION_TTL, RESUMABLE_MAX_CHUNK_SIZE, OffsetConflict,
+    create_session, get_session, delete_session, append_chunk, finish_hash, part_path
+)
+from similarity import near_duplicates_query, to_unsigned, NEAR_DUPLICATE_DISTANCE, PHASH_BITS
+from search_cache import search_cache, make_key as make_search_cache_key
+from task_events import task_events, FINAL_STATUSES
+from conditional import json_etag, body_etag, etag_matches, render_json, json_response, not_modified
+from versions import get_generations, bump_generations, ip_generation_key, CATALOG_GENERATION_KEY
+from transform import (
+    transform_cache, get_transform, transform_source_exists, close_transforms, purge_transforms,
+    validate_key, validate_params,
+    output_format, cache_name, etag_for, media_type
+)
+from metrics import MetricsMiddleware, timed, observe_stage, pools, api_registry, PROMETHEUS_MULTIPROC_DIR
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+import database
+import cache
 from celery_app import celery_app
 import tasks  # Import the module
-from elasticsearch_helper import init_elasticsearch, index_image, search_images
+from elasticsearch_helper import (
+    init_elasticsearch, start_indexer, close_elasticsearch, bulk_indexer,
+    index_image, search_images, suggest_images, delete_image as delete_indexed_image,
+    SEARCHABLE_SOURCE_FIELDS, pool_stats as elasticsearch_pool_stats, warm_pool as warm_elasticsearch_pool
+)
+from resources import POOL_WARMUP, WEB_CONCURRENCY
+
+async def warm_pools():
+    """Open each pool's steady-state connections so the first requests don't pay for connecting"""
+    # A request typically holds one connection of each kind, so warm the others to the DB pool's size
+    results = await asyncio.gather(
+        database.warm_pool(),
+        warm_elasticsearch_pool(database.DB_POOL_SIZE),
+        cache.warm_pool(database.DB_POOL_SIZE),
+        return_exceptions=True
+    )
+    for name, result in zip(("postgres", "elasticsearch", "redis"), results):
+        if isinstance(result, Exception):
+            print(f"Failed to warm up the {name} pool: {result}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Initialize storage, database, Elasticsearch and the Redis cache, and warm their
+    connection pools, before serving. On shutdown, after in-flight requests have
+    finished, flush queued Elasticsearch writes and close every pool.
+    """
+    if WEB_CONCURRENCY > 1 and not PROMETHEUS_MULTIPROC_DIR:
+        print("WEB_CONCURRENCY > 1 without PROMETHEUS_MULTIPROC_DIR: /metrics only reports the worker that answers")
+    await run_in_threadpool(storage.init)
+    await run_in_threadpool(transform_cache.init)
+    await init_db()
+    await init_elasticsearch()
+    start_indexer()
+    task_events.start()
+    pools.register("postgres", database.pool_stats)
+    pools.register("elasticsearch", elasticsearch_pool_stats)
+    pools.register("redis", cache.pool_stats)
+    async with async_session() as db:
+        await init_stats(db)
+        await rebuild_cache(db)
+    if POOL_WARMUP:
+        await warm_pools()
+    print(f"Database and Elasticsearch initialized; pools: {pools.snapshot()}")
 
-app = FastAPI(title="Image Upload Service")
+    try:
+        yield
+    finally:
+        await task_events.stop()
+        await close_elasticsearch()
+        await close_cache()
+        await database.close_db()
+        await run_in_threadpool(close_transforms)
+
+app = FastAPI(title="Image Upload Service", lifespan=lifespan)
 
 # Get allowed origins from environment variable
 ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "*").split(",")
@@ -33,22 +122,20 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
+# Request latency histograms for /metrics
+app.add_middleware(MetricsMiddleware)
+
 # Configuration
-UPLOAD_DIR = Path("/app/uploads")
-UPLOAD_DIR.mkdir(exist_ok=True, parents=True)
-MAX_UPLOADS_PER_IP = int(os.getenv("MAX_UPLOADS_PER_IP", "25"))
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(64 * 1024)))  # 64KB
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "25"))
+STATUS_STREAM_MAX_TASKS = int(os.getenv("STATUS_STREAM_MAX_TASKS", "100"))
+STATUS_STREAM_TIMEOUT = int(os.getenv("STATUS_STREAM_TIMEOUT", "600"))  # seconds
+STATUS_STREAM_KEEPALIVE = 15  # seconds between keepalive comments (and result-backend rechecks)
 
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
 ALLOWED_MIME_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp'}
 
-@app.on_event("startup")
-async def startup_event():
-    """Initialize database and Elasticsearch on startup"""
-    await init_db()
-    await init_elasticsearch()
-    print("Database and Elasticsearch initialized")
-
 def get_client_ip(request: Request) -> str:
     """Get client IP address, considering proxies and Cloudflare"""
     # Cloudflare's CF-Connecting-IP is most reliable and can't be spoofed
@@ -73,43 +160,90 @@ async def calculate_file_hash(file_path: str) -> str:
             sha256_hash.update(chunk)
     return sha256_hash.hexdigest()
 
-async def check_upload_limit(ip_address: str, db: AsyncSession) -> bool:
-    """Check if IP has reached upload limit"""
-    result = await db.execute(
-        select(UploadLimit).where(UploadLimit.ip_address == ip_address)
-    )
-    limit_record = result.scalar_one_or_none()
-    
-    if limit_record is None:
-        return True  # No record yet, allow upload
-    
-    return limit_record.upload_count < MAX_UPLOADS_PER_IP
+async def stream_upload_to_disk(file: UploadFile) -> tuple[Path, str, int]:
+    """
+    Stream an upload into a temp file in the storage staging directory, hashing chunks as they arrive.
+    Returns (temp_path, sha256, size). The caller renames or removes the temp file.
+    """
+    # Reject early when the size is already known from the multipart parser
+    if file.size is not None and file.size > MAX_FILE_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large. Maximum size is {MAX_FILE_SIZE / 1024 / 1024}MB"
+        )
 
-async def increment_upload_count(ip_address: str, db: AsyncSession):
-    """Increment upload count for IP"""
-    result = await db.execute(
-        select(UploadLimit).where(UploadLimit.ip_address == ip_address)
-    )
-    limit_record = result.scalar_one_or_none()
-    
-    if limit_record is None:
-        # Create new record
-        limit_record = UploadLimit(ip_address=ip_address, upload_count=1)
-        db.add(limit_record)
-    else:
-        # Increment existing
-        limit_record.upload_count += 1
-        limit_record.updated_at = datetime.utcnow()
-    
-    await db.commit()
+    sha256_hash = hashlib.sha256()
+    file_size = 0
+    temp_path = storage.staging_dir / f".upload_{uuid.uuid4().hex}.part"
 
-async def get_upload_count(ip_address: str, db: AsyncSession) -> int:
-    """Get current upload count for IP"""
-    result = await db.execute(
-        select(UploadLimit).where(UploadLimit.ip_address == ip_address)
+    # Stage totals for the whole file; the reads, hashing and writes interleave per chunk
+    read_seconds = hash_seconds = write_seconds = 0.0
+    try:
+        async with aiofiles.open(temp_path, "wb") as f:
+            while True:
+                started = time.perf_counter()
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                read_seconds += time.perf_counter() - started
+                if not chunk:
+                    break
+                file_size += len(chunk)
+                if file_size > MAX_FILE_SIZE:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File too large. Maximum size is {MAX_FILE_SIZE / 1024 / 1024}MB"
+                    )
+                started = time.perf_counter()
+                sha256_hash.update(chunk)
+                hash_seconds += time.perf_counter() - started
+                started = time.perf_counter()
+                await f.write(chunk)
+                write_seconds += time.perf_counter() - started
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+    observe_stage("upload", "read", read_seconds)
+    observe_stage("upload", "hash", hash_seconds)
+    observe_stage("upload", "staging_write", write_seconds)
+    return temp_path, sha256_hash.hexdigest(), file_size
+
+def parse_tags(tags) -> list:
+    """Tags arrive as a JSON list (a string from form fields); anything else means no tags"""
+    if isinstance(tags, str):
+        try:
+            tags = json.loads(tags) if tags else []
+        except json.JSONDecodeError:
+            return []
+    return tags if isinstance(tags, list) else []
+
+def validate_file_type(filename: Optional[str], content_type: Optional[str]) -> str:
+    """Check the extension and MIME type of an upload; returns the lowercased extension"""
+    file_ext = Path(filename or "").suffix.lower()
+    if file_ext not in ALLOWED_EXTENSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
+        )
+    if content_type not in ALLOWED_MIME_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid MIME type. Must be an image."
+        )
+    return file_ext
+
+def duplicate_response(image_id: int, filename: str, uploaded_at: str) -> JSONResponse:
+    """Response for an upload whose hash matches an existing image"""
+    return JSONResponse(
+        status_code=200,
+        content={
+            "message": "Image already exists (duplicate detected)",
+            "is_duplicate": True,
+            "image_id": image_id,
+            "filename": filename,
+            "url": url_for(filename),
+            "uploaded_at": uploaded_at
+        }
     )
-    limit_record = result.scalar_one_or_none()
-    return limit_record.upload_count if limit_record else 0
 
 @app.get("/")
 async def root():
@@ -117,12 +251,151 @@ async def root():
         "message": "Image Upload Service API",
         "endpoints": {
             "upload": "/upload",
+            "upload_batch": "/upload/batch",
+            "upload_resumable": "/upload/resumable",
             "status": "/status/{task_id}",
+            "status_stream": "/status/stream",
             "stats": "/stats",
-            "my_uploads": "/my-uploads"
+            "my_uploads": "/my-uploads",
+            "search": "/search",
+            "suggest": "/suggest",
+            "similar": "/similar/{image_id}"
         }
     }
 
+async def store_upload(
+    db: AsyncSession,
+    client_ip: str,
+    temp_path: Path,
+    file_hash: str,
+    file_size: int,
+    file_ext: str,
+    original_filename: str,
+    mime_type: str,
+    image_name: str,
+    description: str,
+    tags_list: list
+) -> JSONResponse:
+    """
+    Commit a fully received, hashed upload: duplicate check, quota slot, image
+    record and stats in one transaction, then cache, index and queue processing.
+    Consumes temp_path either way.
+    """
+    # Known hashes are answered from the cache
+    with timed("upload", "hash_cache_lookup"):
+        cached_image = await get_cached_image(file_hash)
+    if cached_image:
+        temp_path.unlink(missing_ok=True)
+        return duplicate_response(cached_image["id"], cached_image["filename"], cached_image["uploaded_at"])
+    
+    stored = False
+    try:
+        # Reserve a quota slot; it is committed together with the image record
+        with timed("upload", "quota_reserve"):
+            current_count = await reserve_upload_slot(client_ip, db)
+        if current_count is None:
+            await set_cached_upload_count(client_ip, MAX_UPLOADS_PER_IP)
+            raise HTTPException(
+                status_code=429,
+                detail=f"Upload limit reached. You have uploaded {MAX_UPLOADS_PER_IP}/{MAX_UPLOADS_PER_IP} images."
+            )
+        
+        # Check for duplicate
+        with timed("upload", "duplicate_check"):
+            result = await db.execute(
+                select(ImageModel).where(ImageModel.file_hash == file_hash)
+            )
+            existing_image = result.scalar_one_or_none()
+        
+        if existing_image:
+            # Duplicates don't count against the quota
+            await db.rollback()
+            temp_path.unlink(missing_ok=True)
+            await cache_image(file_hash, existing_image.id, existing_image.filename, existing_image.uploaded_at)
+            return duplicate_response(
+                existing_image.id, existing_image.filename, existing_image.uploaded_at.isoformat()
+            )
+        
+        # Content-addressed key, sharded by hash prefix; it is also the filename and URL path
+        unique_filename = content_key(file_hash, file_ext)
+        
+        # Create database record
+        image_record = ImageModel(
+            filename=unique_filename,
+            original_filename=original_filename,
+            name=image_name,
+            description=description,
+            tags=tags_list,
+            file_hash=file_hash,
+            file_size=file_size,
+            mime_type=mime_type,
+            ip_address=client_ip,
+            processed=False
+        )
+        
+        db.add(image_record)
+        with timed("upload", "insert"):
+            await db.flush()
+        
+        # Move the temp file into place now that the hash is known
+        # (an atomic rename on local disk, a multipart upload on S3)
+        with timed("upload", "storage_save"):
+            await run_in_threadpool(storage.save, temp_path, unique_filename)
+        stored = True
+        
+        with timed("upload", "commit"):
+            # A first live image for this IP makes it a new uploader
+            await apply_stats_delta(db, images=1, size=file_size, uploaders=1 if current_count == 1 else 0)
+            
+            # Quota increment, image insert and stats land in the same commit
+            await db.commit()
+    except BaseException:
+        # Rolling back releases the reserved slot
+        await db.rollback()
+        temp_path.unlink(missing_ok=True)
+        if stored:
+            await run_in_threadpool(storage.delete, unique_filename)
+        raise
+    
+    # Write the committed state through to the cache
+    with timed("upload", "cache_write"):
+        await adjust_cached_upload_count(client_ip, 1)
+        await cache_image(file_hash, image_record.id, unique_filename, image_record.uploaded_at)
+        await bump_generations([client_ip])
+    
+    # Queue for indexing in Elasticsearch
+    image_url = url_for(unique_filename)
+    with timed("upload", "index_enqueue"):
+        await index_image(
+            image_id=image_record.id,
+            name=image_name,
+            description=description,
+            tags=tags_list,
+            url=image_url,
+            file_hash=file_hash,
+            uploaded_at=image_record.uploaded_at
+        )
+    
+    # Queue image processing task; in batch mode the periodic batch task picks it up
+    task_id = None
+    if PROCESSING_MODE != "batch":
+        with timed("upload", "task_publish"):
+            task_id = tasks.process_image.delay(image_record.id, unique_filename).id
+    
+    return JSONResponse(
+        status_code=201,
+        content={
+            "message": "Image uploaded successfully",
+            "is_duplicate": False,
+            "image_id": image_record.id,
+            "filename": unique_filename,
+            "url": url_for(unique_filename),
+            "task_id": task_id,
+            "file_hash": file_hash,
+            "uploads_used": f"{current_count}/{MAX_UPLOADS_PER_IP}"
+        }
+    )
+
 @app.post("/upload")
 async def upload_image(
     request: Request,
@@ -136,10 +409,7 @@ async def upload_image(
     Upload an image with duplicate detection, IP limiting, and metadata
     """
     # Parse tags from JSON string
-    try:
-        tags_list = json.loads(tags) if tags else []
-    except json.JSONDecodeError:
-        tags_list = []
+    tags_list = parse_tags(tags)
     
     # Use provided name or fallback to filename
     image_name = name if name else file.filename
@@ -147,128 +417,435 @@ async def upload_image(
     # Get client IP
     client_ip = get_client_ip(request)
     
-    # Check upload limit
-    if not await check_upload_limit(client_ip, db):
-        current_count = await get_upload_count(client_ip, db)
+    # Reject over-quota IPs from the cache without touching Postgres
+    with timed("upload", "quota_precheck"):
+        cached_count = await get_cached_upload_count(client_ip)
+    if cached_count is not None and cached_count >= MAX_UPLOADS_PER_IP:
         raise HTTPException(
             status_code=429,
-            detail=f"Upload limit reached. You have uploaded {current_count}/{MAX_UPLOADS_PER_IP} images."
+            detail=f"Upload limit reached. You have uploaded {cached_count}/{MAX_UPLOADS_PER_IP} images."
         )
     
-    # Validate file extension
-    file_ext = Path(file.filename).suffix.lower()
-    if file_ext not in ALLOWED_EXTENSIONS:
+    # Validate file extension and MIME type
+    file_ext = validate_file_type(file.filename, file.content_type)
+    mime_type = file.content_type
+    
+    # Stream to a temp file while hashing, so memory use stays at one chunk
+    temp_path, file_hash, file_size = await stream_upload_to_disk(file)
+    
+    return await store_upload(
+        db, client_ip, temp_path, file_hash, file_size, file_ext,
+        file.filename, mime_type, image_name, description, tags_list
+    )
+
+@app.post("/upload/batch")
+async def upload_batch(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    metadata: str = Form("[]"),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Upload several images in one request. `metadata` is a JSON list of
+    {"name", "description", "tags"} objects matched to `files` by position.
+    Quota, duplicate lookup, insert, indexing and task publishing happen once
+    for the whole batch; the response carries a status for every file.
+    """
+    if len(files) > MAX_BATCH_FILES:
         raise HTTPException(
             status_code=400,
-            detail=f"Invalid file type. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
+            detail=f"Too many files. Maximum per batch is {MAX_BATCH_FILES}"
         )
     
-    # Validate MIME type
-    mime_type = file.content_type
-    if mime_type not in ALLOWED_MIME_TYPES:
+    try:
+        metadata_list = json.loads(metadata) if metadata else []
+    except json.JSONDecodeError:
+        metadata_list = []
+    if not isinstance(metadata_list, list):
+        metadata_list = []
+    
+    client_ip = get_client_ip(request)
+    
+    # Reject over-quota IPs from the cache without touching Postgres
+    cached_count = await get_cached_upload_count(client_ip)
+    if cached_count is not None and cached_count >= MAX_UPLOADS_PER_IP:
         raise HTTPException(
-            status_code=400,
-            detail=f"Invalid MIME type. Must be an image."
+            status_code=429,
+            detail=f"Upload limit reached. You have uploaded {cached_count}/{MAX_UPLOADS_PER_IP} images."
         )
     
-    # Read file content
-    content = await file.read()
-    file_size = len(content)
+    results = [None] * len(files)
+    staged = []  # (index, temp_path, file_hash, file_size, file_ext)
+    stored_keys = []
+    try:
+        # Validate and stream every file to a temp file, hashing as it goes
+        for index, file in enumerate(files):
+            try:
+                file_ext = validate_file_type(file.filename, file.content_type)
+                temp_path, file_hash, file_size = await stream_upload_to_disk(file)
+            except HTTPException as e:
+                results[index] = {"original_filename": file.filename, "status": "rejected", "error": e.detail}
+                continue
+            staged.append((index, temp_path, file_hash, file_size, file_ext))
+        
+        # One round trip finds every hash that is already stored
+        existing = {}
+        hashes = list({file_hash for _, _, file_hash, _, _ in staged})
+        if hashes:
+            result = await db.execute(
+                select(ImageModel.id, ImageModel.filename, ImageModel.file_hash, ImageModel.uploaded_at)
+                .where(ImageModel.file_hash == any_(hashes))
+            )
+            existing = {row.file_hash: row for row in result.all()}
+        
+        # First occurrence of each new hash is stored; repeats within the batch are duplicates of it
+        new_items = []
+        batch_duplicates = []
+        first_index = {}
+        for item in staged:
+            index, temp_path, file_hash, _, _ = item
+            if file_hash in existing:
+                row = existing[file_hash]
+                results[index] = {
+                    "original_filename": files[index].filename,
+                    "status": "duplicate",
+                    "image_id": row.id,
+                    "filename": row.filename,
+                    "url": url_for(row.filename),
+                    "uploaded_at": row.uploaded_at.isoformat()
+                }
+                temp_path.unlink(missing_ok=True)
+            elif file_hash in first_index:
+                batch_duplicates.append(item)
+                temp_path.unlink(missing_ok=True)
+            else:
+                first_index[file_hash] = index
+                new_items.append(item)
+        
+        # Grant as many slots as the quota allows; the rest of the batch is rejected
+        upload_count, granted = (await reserve_upload_slots(client_ip, len(new_items), db)) if new_items else (None, 0)
+        for index, temp_path, _, _, _ in new_items[granted:]:
+            results[index] = {
+                "original_filename": files[index].filename,
+                "status": "rejected",
+                "error": f"Upload limit reached ({MAX_UPLOADS_PER_IP}/{MAX_UPLOADS_PER_IP} images)"
+            }
+            temp_path.unlink(missing_ok=True)
+        new_items = new_items[:granted]
+        
+        inserted = {}
+        rows_by_hash = {}
+        if new_items:
+            rows = []
+            for index, _, file_hash, file_size, file_ext in new_items:
+                file = files[index]
+                meta = metadata_list[index] if index < len(metadata_list) and isinstance(metadata_list[index], dict) else {}
+                rows.append({
+                    "filename": content_key(file_hash, file_ext),
+                    "original_filename": file.filename,
+                    "name": meta.get("name") or file.filename,
+                    "description": meta.get("description") or "",
+                    "tags": parse_tags(meta.get("tags")),
+                    "file_hash": file_hash,
+                    "file_size": file_size,
+                    "mime_type": file.content_type,
+                    "ip_address": client_ip,
+                    "processed": False
+                })
+            
+            # Multi-row insert; a hash inserted concurrently by another request is skipped, not an error
+            result = await db.execute(
+                pg_insert(ImageModel)
+                .values(rows)
+                .on_conflict_do_nothing(index_elements=[ImageModel.file_hash])
+                .returning(ImageModel.id, ImageModel.file_hash, ImageModel.uploaded_at)
+            )
+            inserted = {row.file_hash: row for row in result.all()}
+            rows_by_hash = {row["file_hash"]: row for row in rows}
+            
+            lost = [item for item in new_items if item[2] not in inserted]
+            if lost:
+                upload_count = await release_upload_slot(client_ip, db, count=len(lost))
+                result = await db.execute(
+                    select(ImageModel.id, ImageModel.filename, ImageModel.file_hash, ImageModel.uploaded_at)
+                    .where(ImageModel.file_hash == any_([item[2] for item in lost]))
+                )
+                existing.update({row.file_hash: row for row in result.all()})
+                for index, temp_path, file_hash, _, _ in lost:
+                    row = existing.get(file_hash)
+                    results[index] = {
+                        "original_filename": files[index].filename,
+                        "status": "duplicate",
+                        "image_id": row.id if row else None,
+                        "filename": row.filename if row else None,
+                        "url": url_for(row.filename) if row else None,
+                        "uploaded_at": row.uploaded_at.isoformat() if row else None
+                    }
+                    temp_path.unlink(missing_ok=True)
+            
+            for index, temp_path, file_hash, _, _ in new_items:
+                if file_hash in inserted:
+                    key = rows_by_hash[file_hash]["filename"]
+                    await run_in_threadpool(storage.save, temp_path, key)
+                    stored_keys.append(key)
+            
+            if inserted:
+                # A first live image for this IP makes it a new uploader
+                previous_count = upload_count - len(inserted)
+                await apply_stats_delta(
+                    db,
+                    images=len(inserted),
+                    size=sum(rows_by_hash[file_hash]["file_size"] for file_hash in inserted),
+                    uploaders=1 if previous_count == 0 else 0
+                )
+        
+        # Quota, inserts and stats land in the same commit
+        await db.commit()
+    except BaseException:
+        # Rolling back releases the reserved slots
+        await db.rollback()
+        for _, temp_path, _, _, _ in staged:
+            temp_path.unlink(missing_ok=True)
+        for key in stored_keys:
+            await run_in_threadpool(storage.delete, key)
+        raise
     
-    # Check file size
-    if file_size > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=413,
-            detail=f"File too large. Maximum size is {MAX_FILE_SIZE / 1024 / 1024}MB"
+    # Write the committed state through to the cache and queue indexing
+    await adjust_cached_upload_count(client_ip, len(inserted))
+    if inserted:
+        await bump_generations([client_ip])
+    uploaded = [item for item in new_items if item[2] in inserted]
+    for index, _, file_hash, _, _ in uploaded:
+        row = rows_by_hash[file_hash]
+        image = inserted[file_hash]
+        await cache_image(file_hash, image.id, row["filename"], image.uploaded_at)
+        # Queued writes leave in shared _bulk requests
+        await index_image(
+            image_id=image.id,
+            name=row["name"],
+            description=row["description"],
+            tags=row["tags"],
+            url=url_for(row["filename"]),
+            file_hash=file_hash,
+            uploaded_at=image.uploaded_at
         )
     
-    # Calculate hash for duplicate detection
-    file_hash = hashlib.sha256(content).hexdigest()
+    # One group publish for the whole batch; in batch mode the periodic batch task picks them up
+    task_ids = [None] * len(uploaded)
+    if uploaded and PROCESSING_MODE != "batch":
+        group_result = group(
+            tasks.process_image.s(inserted[file_hash].id, rows_by_hash[file_hash]["filename"])
+            for _, _, file_hash, _, _ in uploaded
+        ).apply_async()
+        task_ids = [child.id for child in group_result.results]
     
-    # Check for duplicate
-    result = await db.execute(
-        select(ImageModel).where(ImageModel.file_hash == file_hash)
-    )
-    existing_image = result.scalar_one_or_none()
+    for (index, _, file_hash, _, _), task_id in zip(uploaded, task_ids):
+        key = rows_by_hash[file_hash]["filename"]
+        results[index] = {
+            "original_filename": files[index].filename,
+            "status": "uploaded",
+            "image_id": inserted[file_hash].id,
+            "filename": key,
+            "url": url_for(key),
+            "task_id": task_id,
+            "file_hash": file_hash
+        }
     
-    if existing_image:
-        return JSONResponse(
-            status_code=200,
-            content={
-                "message": "Image already exists (duplicate detected)",
-                "is_duplicate": True,
-                "image_id": existing_image.id,
-                "filename": existing_image.filename,
-                "url": f"/images/{existing_image.filename}",
-                "uploaded_at": existing_image.uploaded_at.isoformat()
+    # Repeats within the batch share the outcome of their first occurrence
+    for index, _, file_hash, _, _ in batch_duplicates:
+        first = results[first_index[file_hash]]
+        if first["status"] == "rejected":
+            results[index] = {**first, "original_filename": files[index].filename}
+        else:
+            results[index] = {
+                "original_filename": files[index].filename,
+                "status": "duplicate",
+                "image_id": first["image_id"],
+                "filename": first["filename"],
+                "url": first["url"]
             }
-        )
     
-    # Generate unique filename
-    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    unique_filename = f"{timestamp}_{file_hash[:12]}{file_ext}"
-    file_path = UPLOAD_DIR / unique_filename
-    
-    # Save file
-    async with aiofiles.open(file_path, 'wb') as f:
-        await f.write(content)
-    
-    # Create database record
-    image_record = ImageModel(
-        filename=unique_filename,
-        original_filename=file.filename,
-        name=image_name,
-        description=description,
-        tags=tags_list,
-        file_hash=file_hash,
-        file_size=file_size,
-        mime_type=mime_type,
-        ip_address=client_ip,
-        processed=False
-    )
+    counts = {status: sum(1 for r in results if r["status"] == status) for status in ("uploaded", "duplicate", "rejected")}
+    if upload_count is None:
+        upload_count = cached_count if cached_count is not None else await get_upload_count(client_ip, db)
     
-    db.add(image_record)
-    await db.commit()
-    await db.refresh(image_record)
-    
-    # Index in Elasticsearch
-    image_url = f"/images/{unique_filename}"
-    await index_image(
-        image_id=image_record.id,
-        name=image_name,
-        description=description,
-        tags=tags_list,
-        url=image_url,
-        file_hash=file_hash,
-        uploaded_at=image_record.uploaded_at
+    return JSONResponse(
+        status_code=201 if counts["uploaded"] else 200,
+        content={
+            "message": f"{counts['uploaded']} uploaded, {counts['duplicate']} duplicates, {counts['rejected']} rejected",
+            **counts,
+            "uploads_used": f"{upload_count}/{MAX_UPLOADS_PER_IP}",
+            "results": results
+        }
     )
+
+async def get_own_session(upload_id: str, request: Request) -> dict:
+    """A resumable session belonging to the caller's IP; anyone else gets a 404"""
+    session = await get_session(upload_id)
+    if session is None or session["ip_address"] != get_client_ip(request):
+        raise HTTPException(status_code=404, detail="Upload session not found or expired")
+    return session
+
+def session_response(session: dict, status_code: int = 200) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={
+            "upload_id": session["upload_id"],
+            "offset": session["offset"],
+            "size": session["size"],
+            "max_chunk_size": RESUMABLE_MAX_CHUNK_SIZE,
+            "expires_in": RESUMABLE_SESSION_TTL
+        },
+        headers={"Upload-Offset": str(session["offset"]), "Upload-Length": str(session["size"])}
+    )
+
+@app.post("/upload/resumable")
+async def create_resumable_upload(
+    request: Request,
+    filename: str = Form(...),
+    content_type: str = Form(...),
+    size: int = Form(..., gt=0),
+    name: str = Form(None),
+    description: str = Form(""),
+    tags: str = Form("[]")
+):
+    """
+    Open a resumable upload. Send the bytes with PATCH /upload/resumable/{upload_id}
+    (Upload-Offset header, raw body, at most max_chunk_size bytes per request),
+    check progress with GET, then POST .../complete. Sessions expire expires_in
+    seconds after their last chunk.
+    """
+    client_ip = get_client_ip(request)
     
-    # Increment upload count for this IP
-    await increment_upload_count(client_ip, db)
+    cached_count = await get_cached_upload_count(client_ip)
+    if cached_count is not None and cached_count >= MAX_UPLOADS_PER_IP:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Upload limit reached. You have uploaded {cached_count}/{MAX_UPLOADS_PER_IP} images."
+        )
     
-    # Queue image processing task
-    task = tasks.process_image.delay(image_record.id, str(file_path))
+    validate_file_type(filename, content_type)
+    if size > MAX_FILE_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large. Maximum size is {MAX_FILE_SIZE / 1024 / 1024}MB"
+        )
     
-    # Get updated count
-    current_count = await get_upload_count(client_ip, db)
+    session = await create_session(
+        client_ip, filename, content_type, size,
+        {"name": name or filename, "description": description, "tags": parse_tags(tags)}
+    )
+    return session_response(session, status_code=201)
+
+@app.get("/upload/resumable/{upload_id}")
+async def get_resumable_upload(upload_id: str, request: Request):
+    """Current offset of a resumable upload; resume by PATCHing from there"""
+    return session_response(await get_own_session(upload_id, request))
+
+@app.patch("/upload/resumable/{upload_id}")
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(..., alias="Upload-Offset", ge=0)
+):
+    """Append one chunk (the raw request body) starting at Upload-Offset"""
+    session = await get_own_session(upload_id, request)
+    try:
+        offset = await append_chunk(session, upload_offset, request.stream())
+    except OffsetConflict as e:
+        return JSONResponse(
+            status_code=409,
+            content={"detail": str(e), "offset": e.offset},
+            headers={"Upload-Offset": str(e.offset)}
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return session_response({**session, "offset": offset})
+
+@app.post("/upload/resumable/{upload_id}/complete")
+async def complete_resumable_upload(
+    upload_id: str,
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    """Finish a fully received resumable upload; responds like /upload"""
+    session = await get_own_session(upload_id, request)
+    if session["offset"] != session["size"]:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Upload incomplete: received {session['offset']} of {session['size']} bytes"
+        )
     
-    return JSONResponse(
-        status_code=201,
-        content={
-            "message": "Image uploaded successfully",
-            "is_duplicate": False,
-            "image_id": image_record.id,
-            "filename": unique_filename,
-            "url": f"/images/{unique_filename}",
-            "task_id": task.id,
-            "file_hash": file_hash,
-            "uploads_used": f"{current_count}/{MAX_UPLOADS_PER_IP}"
-        }
+    file_hash = await finish_hash(session)
+    # Claim the session; store_upload consumes the part file
+    if not await delete_session(upload_id, remove_part=False):
+        raise HTTPException(status_code=404, detail="Upload session not found or expired")
+    metadata = session["metadata"]
+    return await store_upload(
+        db, session["ip_address"], part_path(upload_id), file_hash, session["size"],
+        Path(session["filename"]).suffix.lower(), session["filename"], session["content_type"],
+        metadata["name"], metadata["description"], metadata["tags"]
     )
 
-@app.get("/status/{task_id}")
-async def get_task_status(task_id: str):
-    """Check the status of an image processing task"""
+@app.delete("/upload/resumable/{upload_id}")
+async def abort_resumable_upload(upload_id: str, request: Request):
+    """Abandon a resumable upload and discard the bytes received so far"""
+    await get_own_session(upload_id, request)
+    await delete_session(upload_id)
+    return {"message": "Upload aborted", "upload_id": upload_id}
+
+@app.get("/images/{key:path}")
+async def get_image(
+    key: str,
+    w: Optional[int] = None,
+    h: Optional[int] = None,
+    fmt: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Serve a stored image that nginx doesn't have on local disk by redirecting
+    to a short-lived presigned URL on the object store.
+
+    With any of w, h or fmt, serve a transform instead: the image fitted inside
+    w x h (never upscaled) and encoded as fmt (webp, jpeg, png, avif), rendered
+    once and then served from the transform cache.
+    """
+    if w is not None or h is not None or fmt is not None:
+        return await get_image_transform(key, w, h, fmt, if_none_match)
+
+    url = await run_in_threadpool(storage.presigned_url, key)
+    if url is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    # Let browsers reuse the redirect for part of the signature's lifetime
+    return RedirectResponse(url, status_code=302, headers={"Cache-Control": f"private, max-age={S3_PRESIGN_EXPIRES // 2}"})
+
+async def get_image_transform(key: str, w: Optional[int], h: Optional[int], fmt: Optional[str], if_none_match: Optional[str]):
+    try:
+        validate_key(key)
+        fmt = output_format(key, validate_params(w, h, fmt))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    name = cache_name(key, w, h, fmt)
+    etag = etag_for(name)
+    # Keys are content-addressed, so a revalidation only has to know the image still exists
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if etag_matches(if_none_match, etag):
+        if not await transform_source_exists(key, name):
+            raise HTTPException(status_code=404, detail="Image not found")
+        return Response(status_code=304, headers=headers)
+
+    try:
+        with timed("transform", "total"):
+            path = await get_transform(key, w, h, fmt, name)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return FileResponse(path, media_type=media_type(fmt), headers=headers)
+
+def task_status(task_id: str) -> dict:
+    """Status of an image processing task from the Celery result backend"""
     task_result = AsyncResult(task_id, app=celery_app)
     
     if task_result.state == 'PENDING':
@@ -296,89 +873,336 @@ async def get_task_status(task_id: str):
             'status': task_result.state.lower()
         }
     
-    return JSONResponse(response)
+    return response
+
+def sse_event(event: dict) -> str:
+    return f"data: {json.dumps(event)}\n\n"
+
+@app.get("/status/stream")
+async def stream_task_status(request: Request, task_ids: str = Query(..., description="Comma-separated task IDs")):
+    """
+    Stream status updates for one or many tasks as Server-Sent Events.
+    Each event is the /status/{task_id} payload plus its task_id; the stream
+    ends once every task has completed or failed.
+    """
+    ids = list(dict.fromkeys(task_id.strip() for task_id in task_ids.split(",") if task_id.strip()))
+    if not ids:
+        raise HTTPException(status_code=400, detail="No task IDs given")
+    if len(ids) > STATUS_STREAM_MAX_TASKS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many task IDs. Maximum is {STATUS_STREAM_MAX_TASKS} per stream"
+        )
+
+    async def events():
+        pending = set(ids)
+        last_sent = {}
+        queue = asyncio.Queue()
+
+        async def snapshot(task_id: str):
+            status = await run_in_threadpool(task_status, task_id)
+            return {"task_id": task_id, **status}
+
+        def changed(event: dict) -> bool:
+            if last_sent.get(event["task_id"]) == event:
+                return False
+            last_sent[event["task_id"]] = event
+            if event["status"] in FINAL_STATUSES:
+                pending.discard(event["task_id"])
+            return True
+
+        # Subscribe here rather than in the handler, so a client gone before the
+        # stream starts never registers a listener, and before the snapshot so an
+        # update landing in between is queued, not lost
+        task_events.subscribe(ids, queue)
+        try:
+            for task_id in ids:
+                event = await snapshot(task_id)
+                if changed(event):
+                    yield sse_event(event)
+
+            deadline = asyncio.get_running_loop().time() + STATUS_STREAM_TIMEOUT
+            while pending and asyncio.get_running_loop().time() < deadline:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=STATUS_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    # A quiet task may have finished while the subscription was reconnecting
+                    for task_id in list(pending):
+                        event = await snapshot(task_id)
+                        if event["status"] in FINAL_STATUSES and changed(event):
+                            yield sse_event(event)
+                    if pending:
+                        yield ": keepalive\n\n"
+                    continue
+                if event["task_id"] in pending and changed(event):
+                    yield sse_event(event)
+        finally:
+            task_events.unsubscribe(ids, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/status/{task_id}")
+async def get_task_status(task_id: str):
+    """Check the status of an image processing task"""
+    return JSONResponse(task_status(task_id))
 
 @app.get("/my-uploads")
 async def get_my_uploads(
     request: Request,
+    limit: int = Query(50, ge=0, le=100),
+    cursor: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
     db: AsyncSession = Depends(get_db)
 ):
-    """Get all uploads from current IP address"""
+    """
+    Get uploads from current IP address, newest first, one page at a time.
+    Pass the returned next_cursor back as `cursor` for the next page;
+    limit=0 returns only the quota numbers.
+    """
     client_ip = get_client_ip(request)
     
-    result = await db.execute(
-        select(ImageModel)
+    after = None
+    if cursor:
+        try:
+            after_uploaded_at, after_id = decode_cursor(cursor, 2)
+            after = (datetime.fromisoformat(after_uploaded_at), int(after_id))
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    # The IP's generation changes with each of its uploads, deletes and processed images
+    etag = None
+    generations = await get_generations([ip_generation_key(client_ip)])
+    if generations:
+        etag = json_etag("my-uploads", client_ip, limit, cursor, MAX_UPLOADS_PER_IP, generations)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    
+    # Keyset page over idx_ip_uploaded, selecting plain columns (no ORM objects)
+    page_query = (
+        select(
+            ImageModel.id,
+            ImageModel.filename,
+            ImageModel.original_filename,
+            ImageModel.file_size,
+            ImageModel.file_hash,
+            ImageModel.uploaded_at,
+            ImageModel.processed,
+            ImageModel.near_duplicate_of
+        )
         .where(ImageModel.ip_address == client_ip)
-        .order_by(ImageModel.uploaded_at.desc())
+        .order_by(ImageModel.uploaded_at.desc(), ImageModel.id.desc())
+        .limit(limit + 1)  # One extra row tells us whether there is a next page
     )
-    images = result.scalars().all()
+    if after:
+        page_query = page_query.where(tuple_(ImageModel.uploaded_at, ImageModel.id) < after)
+    page = page_query.subquery("page")
     
-    upload_count = await get_upload_count(client_ip, db)
+    # Quota count rides along on every row; the outer join keeps one row when the page is empty
+    upload_count_query = (
+        select(func.coalesce(UploadLimit.upload_count, 0))
+        .where(UploadLimit.ip_address == client_ip)
+        .scalar_subquery()
+    )
+    anchor = select(literal(1).label("anchor")).subquery("anchor")
+    result = await db.execute(
+        select(upload_count_query.label("upload_count"), page)
+        .select_from(anchor.outerjoin(page, true()))
+        # A subquery's ORDER BY doesn't carry through the join
+        .order_by(page.c.uploaded_at.desc(), page.c.id.desc())
+    )
+    rows = result.all()
     
-    return {
+    upload_count = (rows[0].upload_count if rows else None) or 0
+    await set_cached_upload_count(client_ip, upload_count)
+    
+    images = [row for row in rows if row.id is not None]
+    next_cursor = None
+    if len(images) > limit:
+        images = images[:limit]
+        if images:
+            last = images[-1]
+            next_cursor = encode_cursor([last.uploaded_at.isoformat(), last.id])
+    
+    return json_response(request, render_json({
         "ip_address": client_ip,
-        "total_uploads": len(images),
+        "total_uploads": upload_count,
         "uploads_used": f"{upload_count}/{MAX_UPLOADS_PER_IP}",
         "remaining": MAX_UPLOADS_PER_IP - upload_count,
+        "next_cursor": next_cursor,
         "images": [
             {
                 "id": img.id,
                 "filename": img.filename,
                 "original_filename": img.original_filename,
-                "url": f"/images/{img.filename}",
+                "url": url_for(img.filename),
                 "file_size": img.file_size,
                 "file_hash": img.file_hash,
                 "uploaded_at": img.uploaded_at.isoformat(),
-                "processed": img.processed
+                "processed": img.processed,
+                "near_duplicate_of": img.near_duplicate_of
             }
             for img in images
         ]
-    }
+    }), etag)
 
 @app.get("/stats")
-async def get_stats(db: AsyncSession = Depends(get_db)):
-    """Get overall statistics"""
-    # Total images
-    result = await db.execute(select(func.count(ImageModel.id)))
-    total_images = result.scalar()
-    
-    # Total unique IPs
-    result = await db.execute(select(func.count(func.distinct(ImageModel.ip_address))))
-    unique_ips = result.scalar()
-    
-    # Total file size
-    result = await db.execute(select(func.sum(ImageModel.file_size)))
-    total_size = result.scalar() or 0
+async def get_stats(
+    request: Request,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """Get overall statistics from the running totals"""
+    etag = None
+    generations = await get_generations([CATALOG_GENERATION_KEY])
+    if generations:
+        etag = json_etag("stats", MAX_UPLOADS_PER_IP, generations)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
     
-    # Processed images
-    result = await db.execute(
-        select(func.count(ImageModel.id)).where(ImageModel.processed == True)
-    )
-    processed_images = result.scalar()
+    stats = await get_catalog_stats(db)
     
-    return {
-        "total_images": total_images,
-        "unique_uploaders": unique_ips,
-        "total_size_mb": round(total_size / 1024 / 1024, 2),
-        "processed_images": processed_images,
+    return json_response(request, render_json({
+        "total_images": stats["total_images"],
+        "unique_uploaders": stats["unique_uploaders"],
+        "total_size_mb": round(stats["total_size"] / 1024 / 1024, 2),
+        "processed_images": stats["processed_images"],
         "max_uploads_per_ip": MAX_UPLOADS_PER_IP
-    }
+    }), etag)
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "indexer": bulk_indexer.stats(),
+        "search_cache": search_cache.stats(),
+        "pools": pools.snapshot(),
+        "transform_cache": transform_cache.stats()
+    }
+
+metrics_registry = api_registry()
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics, summed over the uvicorn workers when PROMETHEUS_MULTIPROC_DIR is set"""
+    return Response(generate_latest(metrics_registry), media_type=CONTENT_TYPE_LATEST)
+
+def search_body(page: dict, track_total_hits: bool) -> bytes:
+    response = {
+        "results": page["results"],
+        "count": len(page["results"]),
+        "next_cursor": page["next_cursor"]
+    }
+    if track_total_hits:
+        response["total"] = page["total"]
+    return render_json(response)
 
 @app.get("/search")
-async def search(q: str = ""):
+async def search(
+    request: Request,
+    q: str = "",
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    track_total_hits: bool = False,
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Search images by name, description, or tags using Elasticsearch.
+    Pass the returned next_cursor back as `cursor` for the next page, and
+    `fields` (comma-separated) to return only those document fields.
+    The ETag is a digest of the body, kept with the cached page, so a
+    revalidation that hits the search cache never reaches Elasticsearch.
+    """
+    if not q.strip():
+        return {"results": [], "count": 0, "next_cursor": None}
+
+    field_list = None
+    if fields:
+        field_list = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = set(field_list) - SEARCHABLE_SOURCE_FIELDS
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+            )
+
+    cache_key = make_search_cache_key(q, limit, cursor, field_list, track_total_hits)
+    with timed("search", "cache_lookup"):
+        page, generation = await search_cache.get(cache_key)
+    body = None
+    if page is None:
+        try:
+            with timed("search", "query"):
+                page = await search_images(
+                    q, size=limit, cursor=cursor, fields=field_list, track_total_hits=track_total_hits
+                )
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        body = search_body(page, track_total_hits)
+        page["etag"] = body_etag(body)
+        if not page.get("failed"):
+            with timed("search", "cache_store"):
+                await search_cache.set(cache_key, page, generation)
+
+    etag = page.get("etag")
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    if body is None:
+        body = search_body(page, track_total_hits)
+    return json_response(request, body, etag or body_etag(body))
+
+@app.get("/suggest")
+async def suggest(q: str = "", limit: int = Query(5, ge=1, le=20)):
     """
-    Search images by name, description, or tags using Elasticsearch
+    As-you-type suggestions for image names and tags.
+    Uses the completion suggester, so each keystroke is a cheap prefix lookup.
     """
     if not q.strip():
-        return {"results": []}
+        return {"suggestions": []}
 
-    results = await search_images(q)
-    return {"results": results, "count": len(results)}
+    suggestions = await suggest_images(q.strip(), size=limit)
+    return {"suggestions": suggestions}
+
+@app.get("/similar/{image_id}")
+async def similar_images(
+    image_id: int,
+    max_distance: int = Query(NEAR_DUPLICATE_DISTANCE, ge=0, le=PHASH_BITS),
+    limit: int = Query(10, ge=1, le=50),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Near-duplicates of an image (re-encoded, resized or lightly edited copies),
+    closest first, by Hamming distance between perceptual hashes.
+    """
+    result = await db.execute(select(ImageModel.phash).where(ImageModel.id == image_id))
+    row = result.first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    if row.phash is None:
+        raise HTTPException(status_code=409, detail="Image has not been processed yet")
+
+    result = await db.execute(
+        near_duplicates_query(to_unsigned(row.phash), max_distance, exclude_id=image_id, limit=limit)
+    )
+    return {
+        "image_id": image_id,
+        "similar": [
+            {
+                "id": match.id,
+                "filename": match.filename,
+                "url": url_for(match.filename),
+                "distance": match.distance
+            }
+            for match in result.all()
+        ]
+    }
 
 @app.delete("/delete/{file_hash}")
 async def delete_image(
@@ -407,38 +1231,38 @@ async def delete_image(
             detail="You can only delete images you uploaded"
         )
 
-    # Delete the physical file
-    file_path = UPLOAD_DIR / image.filename
-    if file_path.exists():
-        file_path.unlink()
-
-    # Delete thumbnail if exists
-    thumb_path = UPLOAD_DIR / "thumbs" / f"thumb_{image.filename}"
-    if thumb_path.exists():
-        thumb_path.unlink()
+    # Delete the original, thumbnail and renditions, and anything resized from them
+    await run_in_threadpool(delete_image_files, image.filename, image.thumbnail_path)
+    await run_in_threadpool(purge_transforms, [
+        image.filename,
+        image.thumbnail_path or thumbnail_key(image.filename),
+        *(rendition["url"].removeprefix("/images/") for rendition in image.renditions or [])
+    ])
 
     # Delete from Elasticsearch
-    try:
-        from elasticsearch_helper import es_client
-        await es_client.delete(index="images", id=image.id, ignore=[404])
-    except Exception as e:
-        print(f"Error deleting from Elasticsearch: {e}")
+    await delete_indexed_image(image.id)
 
     # Delete from database
     await db.delete(image)
 
-    # Decrement upload count
-    limit_result = await db.execute(
-        select(UploadLimit).where(UploadLimit.ip_address == client_ip)
-    )
-    limit_record = limit_result.scalar_one_or_none()
+    # Give the slot back to the uploader
+    upload_count = await release_upload_slot(client_ip, db)
 
-    if limit_record and limit_record.upload_count > 0:
-        limit_record.upload_count -= 1
-        await db.commit()
+    await apply_stats_delta(
+        db,
+        images=-1,
+        size=-image.file_size,
+        processed=-1 if image.processed else 0,
+        uploaders=-1 if upload_count == 0 else 0
+    )
 
     await db.commit()
 
+    await invalidate_image(file_hash)
+    if upload_count is not None:
+        await adjust_cached_upload_count(client_ip, -1)
+    await bump_generations([client_ip])
+
     return {
         "message": "Image deleted successfully",
         "file_hash": file_hash
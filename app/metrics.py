@@ -0,0 +1,291 @@
+"""
+Prometheus metrics for the API and the Celery worker.
+
+- Request latency per route, and per stage for the upload and search paths
+- Per-call latency of the Postgres, Elasticsearch and Redis clients
+- Connection pool occupancy, read when /metrics is scraped
+- Celery task runtime, queue wait and per-stage processing timings
+
+Observing a histogram is a lock and a few additions, so everything stays on in
+production. With PROMETHEUS_MULTIPROC_DIR set, every process records into that
+directory and the metrics are served summed over the processes: by the API at
+/metrics, across its uvicorn workers, and by the worker's main process on
+WORKER_METRICS_PORT, across its prefork children. Pool gauges are read live, so
+they always describe the process that answered.
+"""
+from contextlib import contextmanager
+from typing import Callable, Dict
+import logging
+import os
+import shutil
+import time
+
+from celery.signals import before_task_publish, task_prerun, task_postrun, worker_init, worker_process_shutdown
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9808"))
+
+# Finer than the defaults at the low end, where cache hits and indexed lookups land
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+REQUEST_SECONDS = Histogram(
+    "nerrf_http_request_duration_seconds",
+    "Time until the response headers are sent, by route",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "nerrf_request_stage_duration_seconds",
+    "Time spent in each stage of the upload and search paths",
+    ["operation", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+DEPENDENCY_SECONDS = Histogram(
+    "nerrf_dependency_duration_seconds",
+    "Latency of individual Postgres, Elasticsearch and Redis calls",
+    ["service", "operation"],
+    buckets=LATENCY_BUCKETS,
+)
+TASK_SECONDS = Histogram(
+    "nerrf_task_duration_seconds",
+    "Celery task runtime",
+    ["task"],
+    buckets=LATENCY_BUCKETS,
+)
+TASK_QUEUE_WAIT_SECONDS = Histogram(
+    "nerrf_task_queue_wait_seconds",
+    "Time between publishing a Celery task and a worker starting it",
+    ["task"],
+    buckets=LATENCY_BUCKETS,
+)
+TASK_STAGE_SECONDS = Histogram(
+    "nerrf_task_stage_duration_seconds",
+    "Time spent in each image processing stage",
+    ["task", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+TASKS_TOTAL = Counter(
+    "nerrf_tasks_total",
+    "Celery tasks finished, by final state",
+    ["task", "state"],
+)
+
+SQL_OPERATIONS = {"select", "insert", "update", "delete", "with", "begin", "commit", "rollback"}
+
+@contextmanager
+def timed(operation: str, stage: str):
+    """Record the block's duration as one stage of operation"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(operation, stage).observe(time.perf_counter() - started)
+
+def observe_stage(operation: str, stage: str, seconds: float):
+    STAGE_SECONDS.labels(operation, stage).observe(seconds)
+
+def observe_task_timings(task: str, timings: dict):
+    """Record a process_file-style {stage: milliseconds} dict"""
+    for stage, ms in timings.items():
+        TASK_STAGE_SECONDS.labels(task, stage).observe(ms / 1000)
+
+class MetricsMiddleware:
+    """ASGI middleware recording REQUEST_SECONDS, labelled with the matched route's path template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                # The router stores the matched route in the shared scope
+                route = getattr(scope.get("route"), "path", "unmatched")
+                REQUEST_SECONDS.labels(scope["method"], route, message["status"]).observe(
+                    time.perf_counter() - started
+                )
+            await send(message)
+
+        await self.app(scope, receive, send_with_metrics)
+
+# --- Client instrumentation ---
+
+def instrument_engine(engine):
+    """Time every statement run through a (sync) SQLAlchemy engine; pass engine.sync_engine for async ones"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_started", None)
+        if started is None:
+            return
+        verb = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ""
+        operation = verb if verb in SQL_OPERATIONS else "other"
+        DEPENDENCY_SECONDS.labels("postgres", operation).observe(time.perf_counter() - started)
+
+def es_operation(method: str, path: str) -> str:
+    """Endpoint name from a request path: /images/_search -> search, /images/_doc/1 -> doc"""
+    for part in reversed(path.split("?", 1)[0].split("/")):
+        if part.startswith("_"):
+            return part.lstrip("_")
+    return method.lower()
+
+class InstrumentedAsyncElasticsearch(AsyncElasticsearch):
+    """AsyncElasticsearch that times each request; .options() clones keep the class"""
+
+    async def perform_request(self, method: str, path: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().perform_request(method, path, **kwargs)
+        finally:
+            DEPENDENCY_SECONDS.labels("elasticsearch", es_operation(method, path)).observe(
+                time.perf_counter() - started
+            )
+
+class InstrumentedElasticsearch(Elasticsearch):
+    """Sync counterpart for the worker"""
+
+    def perform_request(self, method: str, path: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().perform_request(method, path, **kwargs)
+        finally:
+            DEPENDENCY_SECONDS.labels("elasticsearch", es_operation(method, path)).observe(
+                time.perf_counter() - started
+            )
+
+class InstrumentedRedis(aioredis.Redis):
+    """Async Redis client that times each command (pipelines are not timed)"""
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            DEPENDENCY_SECONDS.labels("redis", str(args[0]).lower()).observe(time.perf_counter() - started)
+
+# --- Pool occupancy, read at scrape time ---
+
+class PoolCollector:
+    """
+    Reports registered pools as nerrf_pool_connections{pool, state} and
+    nerrf_pool_saturation{pool}, the share of the pool's maximum in use.
+    Each stats callable returns connection counts by state plus "max".
+    """
+
+    def __init__(self):
+        self._pools: Dict[str, Callable[[], dict]] = {}
+
+    def register(self, name: str, stats: Callable[[], dict]):
+        self._pools[name] = stats
+
+    def snapshot(self) -> dict:
+        """{pool: {state: count, ..., "max", "saturation"}} for every readable pool"""
+        snapshot = {}
+        for name, stats in self._pools.items():
+            try:
+                values = dict(stats())
+            except Exception as e:
+                logger.warning(f"Failed to read {name} pool stats: {e}")
+                continue
+            if values.get("max"):
+                values["saturation"] = round(values.get("in_use", 0) / values["max"], 3)
+            snapshot[name] = values
+        return snapshot
+
+    def collect(self):
+        connections = GaugeMetricFamily(
+            "nerrf_pool_connections",
+            "Connections per pool by state",
+            labels=["pool", "state"],
+        )
+        saturation = GaugeMetricFamily(
+            "nerrf_pool_saturation",
+            "Fraction of the pool's maximum connections in use",
+            labels=["pool"],
+        )
+        for name, values in self.snapshot().items():
+            for state, value in values.items():
+                if state == "saturation":
+                    saturation.add_metric([name], value)
+                else:
+                    connections.add_metric([name, state], value)
+        yield connections
+        yield saturation
+
+pools = PoolCollector()
+REGISTRY.register(pools)
+
+def multiprocess_registry() -> CollectorRegistry:
+    """A registry summing what every process has recorded into PROMETHEUS_MULTIPROC_DIR"""
+    from prometheus_client import multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+def api_registry() -> CollectorRegistry:
+    """Registry behind the API's /metrics; without PROMETHEUS_MULTIPROC_DIR only this process's"""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = multiprocess_registry()
+    registry.register(pools)
+    return registry
+
+# --- Celery ---
+
+_task_started: Dict[str, float] = {}
+
+@before_task_publish.connect
+def _stamp_enqueued_at(headers=None, **kwargs):
+    # Custom headers end up on task.request in the worker
+    if headers is not None:
+        headers.setdefault("enqueued_at", time.time())
+
+@task_prerun.connect
+def _task_started_handler(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+    enqueued_at = task.request.get("enqueued_at")
+    if enqueued_at:
+        TASK_QUEUE_WAIT_SECONDS.labels(task.name).observe(max(time.time() - float(enqueued_at), 0))
+
+@task_postrun.connect
+def _task_finished_handler(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_SECONDS.labels(task.name).observe(time.perf_counter() - started)
+    TASKS_TOTAL.labels(task.name, (state or "unknown").lower()).inc()
+
+@worker_init.connect
+def _start_worker_metrics_server(**kwargs):
+    """Serve worker metrics; with PROMETHEUS_MULTIPROC_DIR, aggregated over the prefork children"""
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        # Values from a previous run would otherwise be summed in
+        shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+        registry = multiprocess_registry()
+    try:
+        start_http_server(WORKER_METRICS_PORT, registry=registry)
+        logger.info(f"Serving worker metrics on port {WORKER_METRICS_PORT}")
+    except OSError as e:
+        logger.warning(f"Failed to start worker metrics server: {e}")
+
+@worker_process_shutdown.connect
+def _mark_worker_process_dead(pid=None, **kwargs):
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -0,0 +1,182 @@
+"""
+Move flat-named uploads into the content-addressed, sharded storage layout.
+
+For each processed image still stored under its flat {timestamp}_{hash12}{ext}
+name, the original, thumbnail and renditions are hardlinked to their sharded
+keys, the row is rewritten to the new key (remembering the old name in
+legacy_filename) and only after the commit are the old names unlinked, so an
+interrupted run never leaves a row pointing at a missing file. Search documents
+get the new URLs with one _bulk request per batch.
+
+Old URLs stay valid through an nginx map written to legacy_urls.map in the
+data directory (next to, not inside, the served images); reload nginx after a run to pick it up. Unprocessed images
+are skipped, since their processing task still refers to the old name; run the
+command again once they are processed.
+
+Usage:
+    python migrate_storage.py [--batch-size 500] [--map-only]
+"""
+from elasticsearch.helpers import bulk as es_bulk
+from sqlalchemy import select, update
+from pathlib import Path
+import argparse
+import logging
+import os
+
+from elasticsearch_helper import INDEX_NAME
+from models import Image as ImageModel
+from storage import DATA_DIR, storage, content_key, thumbnail_key, rendition_key, url_for
+from tasks import SessionLocal, es_client
+
+logger = logging.getLogger(__name__)
+
+LEGACY_MAP_FILE = DATA_DIR / "legacy_urls.map"
+
+def legacy_rendition_key(legacy_filename: str, rendition: dict) -> str:
+    """Key a rendition had under the flat layout"""
+    return rendition_key(legacy_filename, rendition["width"], Path(rendition["url"]).suffix.lstrip("."))
+
+def migrate_row(row) -> tuple:
+    """
+    Hardlink one image's files to their sharded keys.
+    Returns (new column values, old keys to unlink after commit), or (None, None)
+    if the original is missing.
+    """
+    new_key = content_key(row.file_hash, Path(row.filename).suffix.lower())
+    if not storage.link(row.filename, new_key):
+        logger.warning(f"Skipping image {row.id}: {row.filename} not found")
+        return None, None
+    old_keys = [row.filename]
+
+    old_thumbnail = row.thumbnail_path or thumbnail_key(row.filename)
+    new_thumbnail = thumbnail_key(new_key)
+    if storage.link(old_thumbnail, new_thumbnail):
+        old_keys.append(old_thumbnail)
+    else:
+        new_thumbnail = None
+
+    renditions = []
+    for rendition in row.renditions or []:
+        old_rendition = legacy_rendition_key(row.filename, rendition)
+        new_rendition = rendition_key(new_key, rendition["width"], Path(old_rendition).suffix.lstrip("."))
+        if storage.link(old_rendition, new_rendition):
+            old_keys.append(old_rendition)
+            renditions.append({**rendition, "url": url_for(new_rendition)})
+
+    values = {
+        "filename": new_key,
+        "legacy_filename": row.filename,
+        "thumbnail_path": new_thumbnail,
+        "renditions": renditions,
+    }
+    return values, old_keys
+
+def migrate(batch_size: int) -> dict:
+    stats = {"migrated": 0, "skipped": 0}
+    last_id = 0
+    while True:
+        db = SessionLocal()
+        try:
+            # Flat names have no directory part; rows are locked until the batch commits
+            rows = db.execute(
+                select(
+                    ImageModel.id, ImageModel.filename, ImageModel.file_hash,
+                    ImageModel.thumbnail_path, ImageModel.renditions
+                )
+                .where(
+                    ImageModel.id > last_id,
+                    ImageModel.processed == True,
+                    ImageModel.filename.notlike("%/%")
+                )
+                .order_by(ImageModel.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                db.commit()
+                break
+            last_id = rows[-1].id
+
+            migrated = []
+            for row in rows:
+                values, old_keys = migrate_row(row)
+                if values is None:
+                    stats["skipped"] += 1
+                    continue
+                db.execute(update(ImageModel).where(ImageModel.id == row.id).values(**values))
+                migrated.append((row.id, values, old_keys))
+            db.commit()
+        finally:
+            db.close()
+
+        # The new names are committed; the old ones can go
+        for _, _, old_keys in migrated:
+            for key in old_keys:
+                storage.delete(key)
+
+        try:
+            es_bulk(es_client, [
+                {
+                    "_op_type": "update",
+                    "_index": INDEX_NAME,
+                    "_id": str(image_id),
+                    "doc": {
+                        "url": url_for(values["filename"]),
+                        "thumbnail_url": url_for(values["thumbnail_path"] or thumbnail_key(values["filename"])),
+                        "renditions": values["renditions"],
+                    },
+                    "retry_on_conflict": 3
+                }
+                for image_id, values, _ in migrated
+            ], raise_on_error=False)
+        except Exception as e:
+            logger.error(f"Failed to update migrated images in Elasticsearch: {e}")
+
+        stats["migrated"] += len(migrated)
+        logger.info(f"Migrated {stats['migrated']} images ({stats['skipped']} skipped)")
+    return stats
+
+def write_legacy_map() -> int:
+    """
+    Write the nginx map from old URLs to sharded ones for every migrated image.
+    Written to a temp file and renamed so nginx never reads a partial map.
+    """
+    entries = 0
+    temp_path = LEGACY_MAP_FILE.with_suffix(".tmp")
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            select(ImageModel.legacy_filename, ImageModel.filename, ImageModel.thumbnail_path, ImageModel.renditions)
+            .where(ImageModel.legacy_filename.isnot(None))
+            .execution_options(stream_results=True, yield_per=1000)
+        )
+        with open(temp_path, "w") as f:
+            for row in result:
+                pairs = [
+                    (url_for(row.legacy_filename), url_for(row.filename)),
+                    (
+                        url_for(thumbnail_key(row.legacy_filename)),
+                        url_for(row.thumbnail_path or thumbnail_key(row.filename))
+                    ),
+                ]
+                for rendition in row.renditions or []:
+                    pairs.append((url_for(legacy_rendition_key(row.legacy_filename, rendition)), rendition["url"]))
+                for old_url, new_url in pairs:
+                    f.write(f"{old_url} {new_url};\n")
+                    entries += 1
+    finally:
+        db.close()
+    os.replace(temp_path, LEGACY_MAP_FILE)
+    logger.info(f"Wrote {entries} legacy URL mappings to {LEGACY_MAP_FILE}")
+    return entries
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move flat-named uploads into the sharded storage layout")
+    parser.add_argument("--batch-size", type=int, default=500, help="Images migrated per transaction")
+    parser.add_argument("--map-only", action="store_true", help="Only rewrite the nginx legacy URL map")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if not args.map_only:
+        migrate(args.batch_size)
+    write_legacy_map()
@@ -1,8 +1,8 @@
-from sqlalchemy import Column, String, Integer, DateTime, Boolean, Index, Text, ARRAY
+from sqlalchemy import Column, String, Integer, BigInteger, DateTime, Boolean, Index, Text, ARRAY
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from datetime import datetime
-from sqlalchemy.dialects.postgresql import ARRAY as PG_ARRAY
+from sqlalchemy.dialects.postgresql import ARRAY as PG_ARRAY, JSONB
 
 Base = declarative_base()
 
@@ -10,7 +10,8 @@ class Image(Base):
     __tablename__ = "images"
     
     id = Column(Integer, primary_key=True, index=True)
-    filename = Column(String, nullable=False)
+    filename = Column(String, nullable=False)  # Storage key, e.g. ab/cd/<sha256>.jpg; also the URL path
+    legacy_filename = Column(String)  # Flat pre-sharding name, kept so old URLs can be mapped
     original_filename = Column(String, nullable=False)
     name = Column(String, nullable=False)  # User-provided name
     description = Column(Text, default="")  # User-provided description
@@ -21,11 +22,27 @@ class Image(Base):
     ip_address = Column(String, index=True, nullable=False)
     uploaded_at = Column(DateTime(timezone=True), server_default=func.now())
     processed = Column(Boolean, default=False)
+    renditions = Column(JSONB, default=list)  # [{"width", "height", "format", "url"}] from processing
+    width = Column(Integer)  # Filled in by processing
+    height = Column(Integer)
+    format = Column(String)
+    thumbnail_path = Column(String)  # Relative to the upload directory, e.g. thumbs/<filename>
+    processing_error = Column(Text)  # Set when processing fails so batches skip the image
+    phash = Column(BigInteger)  # 64-bit dHash from processing, see similarity.py
+    phash_0 = Column(Integer, index=True)  # 16-bit segments of phash for indexed near-duplicate lookups
+    phash_1 = Column(Integer, index=True)
+    phash_2 = Column(Integer, index=True)
+    phash_3 = Column(Integer, index=True)
+    near_duplicate_of = Column(Integer)  # Closest earlier image within NEAR_DUPLICATE_DISTANCE, if any
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())  # Lets reindex.py pick up rows changed mid-run
     
     # Add composite index for IP queries
     __table_args__ = (
         Index('idx_ip_uploaded', 'ip_address', 'uploaded_at'),
     )
+    
+    # Fetch server defaults (uploaded_at) via INSERT ... RETURNING instead of a refresh
+    __mapper_args__ = {"eager_defaults": True}
 
 class UploadLimit(Base):
     __tablename__ = "upload_limits"
@@ -35,3 +52,14 @@ class UploadLimit(Base):
     upload_count = Column(Integer, default=0)
     last_reset = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class CatalogStats(Base):
+    """Single-row running totals behind /stats, kept in step with uploads, deletes and processing"""
+    __tablename__ = "catalog_stats"
+    
+    id = Column(Integer, primary_key=True)
+    total_images = Column(BigInteger, nullable=False, default=0)
+    unique_uploaders = Column(BigInteger, nullable=False, default=0)
+    total_size = Column(BigInteger, nullable=False, default=0)
+    processed_images = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -0,0 +1,19 @@
+"""Opaque cursors for keyset pagination (/search and /my-uploads)"""
+import base64
+import json
+
+def encode_cursor(sort_values: list) -> str:
+    """Encode the last row's sort values as an opaque paging cursor"""
+    raw = json.dumps(sort_values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str, length: int) -> list:
+    """Decode a paging cursor of `length` sort values; raises ValueError if it is malformed"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_values = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    if not isinstance(sort_values, list) or len(sort_values) != length:
+        raise ValueError("Invalid cursor")
+    return sort_values
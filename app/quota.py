@@ -0,0 +1,86 @@
+"""
+Per-IP upload quota backed by the upload_limits table.
+
+A slot is reserved with a single INSERT ... ON CONFLICT DO UPDATE ... RETURNING,
+so the limit check and the increment happen atomically in one round trip.
+"""
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import select, update, func
+from typing import Optional, Tuple
+import os
+
+from models import UploadLimit
+
+MAX_UPLOADS_PER_IP = int(os.getenv("MAX_UPLOADS_PER_IP", "25"))
+
+async def reserve_upload_slot(ip_address: str, db: AsyncSession) -> Optional[int]:
+    """
+    Reserve one upload slot for an IP inside the session's current transaction.
+    Returns the new upload count, or None if the IP is already at the limit.
+    Rolling back the transaction releases the slot.
+    """
+    stmt = (
+        pg_insert(UploadLimit)
+        .values(ip_address=ip_address, upload_count=1)
+        .on_conflict_do_update(
+            index_elements=[UploadLimit.ip_address],
+            set_={
+                "upload_count": UploadLimit.upload_count + 1,
+                "updated_at": func.now(),
+            },
+            where=UploadLimit.upload_count < MAX_UPLOADS_PER_IP,
+        )
+        .returning(UploadLimit.upload_count)
+    )
+    result = await db.execute(stmt)
+    return result.scalar_one_or_none()
+
+async def reserve_upload_slots(ip_address: str, count: int, db: AsyncSession) -> Tuple[int, int]:
+    """
+    Reserve up to `count` slots for an IP inside the session's current transaction,
+    granting as many as the limit allows. Returns (new upload count, slots granted).
+    The quota row stays locked until the transaction ends; rolling back releases the slots.
+    """
+    # Make sure the row exists, then lock it so the read and the increment can't interleave
+    await db.execute(
+        pg_insert(UploadLimit)
+        .values(ip_address=ip_address, upload_count=0)
+        .on_conflict_do_nothing(index_elements=[UploadLimit.ip_address])
+    )
+    result = await db.execute(
+        select(UploadLimit.upload_count)
+        .where(UploadLimit.ip_address == ip_address)
+        .with_for_update()
+    )
+    current = result.scalar_one() or 0
+    granted = max(0, min(count, MAX_UPLOADS_PER_IP - current))
+    if granted:
+        await db.execute(
+            update(UploadLimit)
+            .where(UploadLimit.ip_address == ip_address)
+            .values(upload_count=current + granted, updated_at=func.now())
+        )
+    return current + granted, granted
+
+async def release_upload_slot(ip_address: str, db: AsyncSession, count: int = 1) -> Optional[int]:
+    """
+    Give back `count` upload slots for an IP (never going below zero).
+    Returns the new upload count, or None if there was nothing to release.
+    The caller commits.
+    """
+    result = await db.execute(
+        update(UploadLimit)
+        .where(UploadLimit.ip_address == ip_address, UploadLimit.upload_count > 0)
+        .values(upload_count=func.greatest(UploadLimit.upload_count - count, 0), updated_at=func.now())
+        .returning(UploadLimit.upload_count)
+    )
+    return result.scalar_one_or_none()
+
+async def get_upload_count(ip_address: str, db: AsyncSession) -> int:
+    """Get current upload count for IP"""
+    result = await db.execute(
+        select(UploadLimit.upload_count).where(UploadLimit.ip_address == ip_address)
+    )
+    count = result.scalar_one_or_none()
+    return count or 0
@@ -0,0 +1,199 @@
+"""
+Rebuild the Elasticsearch images index from Postgres.
+
+Streams ImageModel rows through a server-side cursor, builds documents with
+build_image_document, bulk-loads them into a new versioned index with parallel
+workers and then atomically points the `images` alias at it.
+
+Writes made while the command runs go to the old index. Once the alias has
+moved they land in the new one, so a final pass re-indexes rows changed since
+the run started and deletes documents whose rows are gone.
+
+Usage:
+    python reindex.py [--batch-size 1000] [--workers 4] [--keep-old]
+"""
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk, parallel_bulk, scan
+from sqlalchemy import func, select
+from datetime import timedelta
+import argparse
+import logging
+import time
+
+from elasticsearch_helper import (
+    ELASTICSEARCH_URL, INDEX_NAME, INDEX_BODY, build_image_document, processing_document_fields,
+    versioned_index_name
+)
+from models import Image as ImageModel
+from tasks import SessionLocal
+from storage import url_for
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_EVERY = 10000
+# Row timestamps are taken when their transaction starts, so a row changed in a
+# transaction that was open when the run started can carry an earlier one
+CHANGED_SINCE_MARGIN = timedelta(minutes=5)
+
+def stream_documents(batch_size: int, after_id: int, stats: dict, changed_since=None):
+    """Yield bulk actions for every image with id > after_id (and updated at or after changed_since), in id order"""
+    db = SessionLocal()
+    try:
+        query = (
+            select(
+                ImageModel.id, ImageModel.name, ImageModel.description, ImageModel.tags,
+                ImageModel.filename, ImageModel.file_hash, ImageModel.uploaded_at,
+                ImageModel.processed, ImageModel.width, ImageModel.height, ImageModel.format,
+                ImageModel.thumbnail_path, ImageModel.renditions
+            )
+            .where(ImageModel.id > after_id)
+            .order_by(ImageModel.id)
+            .execution_options(stream_results=True, yield_per=batch_size)
+        )
+        if changed_since is not None:
+            query = query.where(ImageModel.updated_at >= changed_since)
+        result = db.execute(query)
+        for row in result:
+            stats["last_id"] = row.id
+            yield {
+                "_id": str(row.id),
+                "_source": build_image_document(
+                    image_id=row.id,
+                    name=row.name,
+                    description=row.description,
+                    tags=row.tags or [],
+                    url=url_for(row.filename),
+                    file_hash=row.file_hash,
+                    uploaded_at=row.uploaded_at,
+                    processing=processing_document_fields(
+                        row.width, row.height, row.format, row.thumbnail_path, row.renditions
+                    ) if row.processed else None
+                )
+            }
+    finally:
+        db.close()
+
+def load_documents(client: Elasticsearch, index: str, batch_size: int, workers: int, after_id: int, stats: dict, changed_since=None):
+    """Push documents through parallel bulk workers, reporting docs/sec as it goes"""
+    started = time.monotonic()
+    for ok, info in parallel_bulk(
+        client,
+        stream_documents(batch_size, after_id, stats, changed_since),
+        index=index,
+        thread_count=workers,
+        chunk_size=batch_size,
+        queue_size=workers,  # Bounds the number of in-flight chunks
+        raise_on_error=False,
+        raise_on_exception=False,
+    ):
+        if ok:
+            stats["indexed"] += 1
+        else:
+            stats["failed"] += 1
+            logger.error(f"Failed to index document: {info}")
+
+        done = stats["indexed"] + stats["failed"]
+        if done % PROGRESS_EVERY == 0:
+            rate = done / max(time.monotonic() - started, 1e-9)
+            logger.info(f"{done} documents processed ({rate:.0f} docs/sec)")
+
+def delete_missing(client: Elasticsearch, index: str, batch_size: int, stats: dict):
+    """Delete documents from index whose images no longer exist"""
+    def batches():
+        ids = []
+        for hit in scan(client, index=index, query={"query": {"match_all": {}}}, _source=False, size=batch_size):
+            ids.append(int(hit["_id"]))
+            if len(ids) >= batch_size:
+                yield ids
+                ids = []
+        if ids:
+            yield ids
+
+    db = SessionLocal()
+    try:
+        for ids in batches():
+            existing = set(db.scalars(select(ImageModel.id).where(ImageModel.id.in_(ids))))
+            missing = [image_id for image_id in ids if image_id not in existing]
+            if missing:
+                bulk(
+                    client,
+                    ({"_op_type": "delete", "_index": index, "_id": str(image_id)} for image_id in missing),
+                    raise_on_error=False
+                )
+                stats["deleted"] += len(missing)
+    finally:
+        db.close()
+
+def database_now():
+    db = SessionLocal()
+    try:
+        return db.scalar(select(func.now()))
+    finally:
+        db.close()
+
+def swap_alias(client: Elasticsearch, new_index: str, keep_old: bool):
+    """Point the alias at new_index in a single _aliases call"""
+    actions = [{"add": {"index": new_index, "alias": INDEX_NAME, "is_write_index": True}}]
+    old_indices = []
+
+    if client.indices.exists_alias(name=INDEX_NAME):
+        old_indices = list(client.indices.get_alias(name=INDEX_NAME).keys())
+        actions.insert(0, {"remove": {"index": "*", "alias": INDEX_NAME}})
+    elif client.indices.exists(index=INDEX_NAME):
+        # First run: the live index is a concrete index named like the alias
+        actions.insert(0, {"remove_index": {"index": INDEX_NAME}})
+
+    client.indices.update_aliases(actions=actions)
+    logger.info(f"Alias {INDEX_NAME} now points at {new_index}")
+
+    if not keep_old:
+        for old_index in old_indices:
+            if old_index != new_index:
+                client.indices.delete(index=old_index)
+                logger.info(f"Deleted old index {old_index}")
+
+def reindex(batch_size: int, workers: int, keep_old: bool):
+    client = Elasticsearch([ELASTICSEARCH_URL], request_timeout=120)
+    new_index = versioned_index_name()
+
+    # Bulk-load without replicas or refreshes, then restore the defaults
+    body = {**INDEX_BODY, "settings": {**INDEX_BODY["settings"], "refresh_interval": "-1", "number_of_replicas": 0}}
+    client.indices.create(index=new_index, body=body)
+    logger.info(f"Created index {new_index}")
+
+    stats = {"indexed": 0, "failed": 0, "deleted": 0, "last_id": 0}
+    started = time.monotonic()
+    started_at = database_now()
+
+    load_documents(client, new_index, batch_size, workers, 0, stats)
+    # Catch-up pass for images uploaded while the main pass was running
+    load_documents(client, new_index, batch_size, workers, stats["last_id"], stats)
+
+    client.indices.put_settings(index=new_index, settings={"refresh_interval": None, "number_of_replicas": None})
+    client.indices.refresh(index=new_index)
+    swap_alias(client, new_index, keep_old)
+
+    # New writes now reach new_index; bring over what went to the old index meanwhile.
+    # Deletes run last so a row deleted while it was being re-indexed doesn't linger
+    load_documents(client, new_index, batch_size, workers, 0, stats, changed_since=started_at - CHANGED_SINCE_MARGIN)
+    client.indices.refresh(index=new_index)
+    delete_missing(client, new_index, batch_size, stats)
+
+    elapsed = time.monotonic() - started
+    rate = stats["indexed"] / max(elapsed, 1e-9)
+    logger.info(
+        f"Reindex complete: {stats['indexed']} indexed, {stats['failed']} failed, {stats['deleted']} deleted "
+        f"in {elapsed:.1f}s ({rate:.0f} docs/sec)"
+    )
+    client.close()
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the Elasticsearch images index from Postgres")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Rows per cursor fetch and bulk request")
+    parser.add_argument("--workers", type=int, default=4, help="Parallel bulk worker threads")
+    parser.add_argument("--keep-old", action="store_true", help="Keep the previous index after the alias swap")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    reindex(args.batch_size, args.workers, args.keep_old)
@@ -0,0 +1,26 @@
+"""
+Connection budgets for the API's shared pools.
+
+Each budget is the number of connections the API may hold to a service across
+all of its worker processes. uvicorn starts WEB_CONCURRENCY workers, and each
+one sizes its Postgres, Elasticsearch and Redis pools to an equal share, so
+adding workers doesn't multiply the load on the backing services. Explicit
+per-process sizes (DB_POOL_SIZE etc.) override the derived ones.
+
+The pools are created by database.py, elasticsearch_helper.py and cache.py,
+warmed up and drained by the app's lifespan in main.py, and their occupancy is
+reported on /health and /metrics.
+"""
+import os
+
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))  # Also read by uvicorn as its worker count
+
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "15"))
+ES_CONNECTION_BUDGET = int(os.getenv("ES_CONNECTION_BUDGET", "10"))
+REDIS_CONNECTION_BUDGET = int(os.getenv("REDIS_CONNECTION_BUDGET", "50"))
+
+POOL_WARMUP = os.getenv("POOL_WARMUP", "true").lower() == "true"
+
+def worker_share(budget: int) -> int:
+    """One worker process's share of a connection budget"""
+    return max(1, budget // WEB_CONCURRENCY)
@@ -0,0 +1,155 @@
+"""
+Resumable chunked uploads.
+
+A client opens a session with the file's name, type and size, PATCHes the bytes
+in chunks, each tagged with the offset it starts at, and then completes the
+session. Chunks are appended to a part file in RESUMABLE_DIR, on the data volume
+shared by every API container and the worker.
+The part file's size is the authoritative offset, so an interrupted client asks
+for the current offset and carries on from there instead of starting over.
+
+Session metadata lives in Redis with a sliding TTL and part files on the shared
+volume, so any API worker, in any container, can take any chunk. The running SHA-256 is kept per worker process; a chunk that lands on
+a worker without it (or after a restart) rebuilds it from the part file once.
+Part files whose session has expired are removed by a periodic Celery task.
+"""
+from collections import OrderedDict
+from pathlib import Path
+from typing import AsyncIterator, Optional
+import aiofiles
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+from cache import redis_client
+from storage import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+RESUMABLE_SESSION_TTL = int(os.getenv("RESUMABLE_SESSION_TTL", str(24 * 3600)))  # seconds since the last chunk
+RESUMABLE_DIR = Path(os.getenv("RESUMABLE_DIR", str(DATA_DIR / "resumable")))
+RESUMABLE_MAX_CHUNK_SIZE = int(os.getenv("RESUMABLE_MAX_CHUNK_SIZE", str(8 * 1024 * 1024)))  # bytes
+
+SESSION_KEY_PREFIX = "nerrf:resumable:"
+LOCK_TTL = 120  # seconds; bounds how long a crashed request can block a session
+PART_FILE_PREFIX = ".resumable_"
+HASHER_CACHE_SIZE = 1000
+
+# upload_id -> (offset, running sha256) for sessions this process has seen
+_hashers: OrderedDict = OrderedDict()
+
+class OffsetConflict(Exception):
+    """A chunk didn't start at the session's current offset, or another chunk is in flight"""
+
+    def __init__(self, offset: int, message: str):
+        super().__init__(message)
+        self.offset = offset
+
+def part_path(upload_id: str) -> Path:
+    return RESUMABLE_DIR / f"{PART_FILE_PREFIX}{upload_id}.part"
+
+def current_offset(upload_id: str) -> int:
+    try:
+        return part_path(upload_id).stat().st_size
+    except FileNotFoundError:
+        return 0
+
+async def create_session(ip_address: str, filename: str, content_type: str, size: int, metadata: dict) -> dict:
+    """Open a session and its empty part file"""
+    upload_id = uuid.uuid4().hex
+    session = {
+        "upload_id": upload_id,
+        "ip_address": ip_address,
+        "filename": filename,
+        "content_type": content_type,
+        "size": size,
+        "metadata": metadata,
+    }
+    RESUMABLE_DIR.mkdir(parents=True, exist_ok=True)
+    part_path(upload_id).touch()
+    await redis_client.set(f"{SESSION_KEY_PREFIX}{upload_id}", json.dumps(session), ex=RESUMABLE_SESSION_TTL)
+    return {**session, "offset": 0}
+
+async def get_session(upload_id: str) -> Optional[dict]:
+    """Session with its current offset, or None if it doesn't exist or has expired"""
+    raw = await redis_client.get(f"{SESSION_KEY_PREFIX}{upload_id}")
+    if raw is None:
+        return None
+    return {**json.loads(raw), "offset": current_offset(upload_id)}
+
+async def delete_session(upload_id: str, remove_part: bool = True) -> bool:
+    """Drop a session; returns False if it was already gone (e.g. completed concurrently)"""
+    deleted = await redis_client.delete(f"{SESSION_KEY_PREFIX}{upload_id}")
+    _hashers.pop(upload_id, None)
+    if remove_part:
+        part_path(upload_id).unlink(missing_ok=True)
+    return bool(deleted)
+
+def _hash_file(path: Path):
+    sha256_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha256_hash.update(chunk)
+    return sha256_hash
+
+async def _hasher_at(upload_id: str, offset: int):
+    """Running hash of the first `offset` bytes, rebuilt from the part file if this process lacks it"""
+    cached = _hashers.get(upload_id)
+    if cached is not None and cached[0] == offset:
+        _hashers.move_to_end(upload_id)
+        return cached[1]
+    hasher = await asyncio.to_thread(_hash_file, part_path(upload_id))
+    _remember(upload_id, offset, hasher)
+    return hasher
+
+def _remember(upload_id: str, offset: int, hasher):
+    _hashers[upload_id] = (offset, hasher)
+    _hashers.move_to_end(upload_id)
+    while len(_hashers) > HASHER_CACHE_SIZE:
+        _hashers.popitem(last=False)
+
+async def append_chunk(session: dict, offset: int, chunks: AsyncIterator[bytes]) -> int:
+    """
+    Append a request body to the part file, starting at `offset`.
+    Raises OffsetConflict if offset isn't the current one or another chunk is
+    being written, and ValueError if the chunk is too large or overruns the
+    declared size. Returns the new offset; bytes received before a failure count.
+    """
+    upload_id = session["upload_id"]
+    lock_key = f"{SESSION_KEY_PREFIX}{upload_id}:lock"
+    if not await redis_client.set(lock_key, "1", nx=True, ex=LOCK_TTL):
+        raise OffsetConflict(current_offset(upload_id), "Another chunk is being uploaded for this session")
+    try:
+        start = current_offset(upload_id)
+        if offset != start:
+            raise OffsetConflict(start, f"Chunk starts at {offset}, upload is at {start}")
+
+        hasher = await _hasher_at(upload_id, start)
+        position = start
+        try:
+            async with aiofiles.open(part_path(upload_id), "ab") as f:
+                async for piece in chunks:
+                    if not piece:
+                        continue
+                    if position + len(piece) - start > RESUMABLE_MAX_CHUNK_SIZE:
+                        raise ValueError(f"Chunk too large. Maximum chunk size is {RESUMABLE_MAX_CHUNK_SIZE} bytes")
+                    if position + len(piece) > session["size"]:
+                        raise ValueError("Chunk runs past the declared upload size")
+                    await f.write(piece)
+                    hasher.update(piece)
+                    position += len(piece)
+        finally:
+            # Keep the hash in step with whatever reached the file
+            _remember(upload_id, position, hasher)
+        return position
+    finally:
+        await redis_client.delete(lock_key)
+        # Every chunk extends the session's life
+        await redis_client.expire(f"{SESSION_KEY_PREFIX}{upload_id}", RESUMABLE_SESSION_TTL)
+
+async def finish_hash(session: dict) -> str:
+    """SHA-256 of a fully received upload"""
+    return (await _hasher_at(session["upload_id"], session["offset"])).hexdigest()
@@ -0,0 +1,136 @@
+"""
+Result cache for /search.
+
+An in-process LRU with a TTL sits in front of search_images. Entries are tagged
+with a cache generation; bumping the generation (after indexed writes become
+searchable) makes every older entry unreachable without scanning. With
+SEARCH_CACHE_REDIS enabled, entries and the generation also live in Redis so
+every uvicorn worker shares hits and sees invalidations.
+"""
+from collections import OrderedDict
+from typing import Optional, Tuple
+import hashlib
+import json
+import logging
+import os
+import time
+
+from cache import redis_client
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CACHE_ENABLED = os.getenv("SEARCH_CACHE_ENABLED", "true").lower() == "true"
+SEARCH_CACHE_REDIS = os.getenv("SEARCH_CACHE_REDIS", "false").lower() == "true"
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1000"))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "30"))  # seconds
+
+GENERATION_KEY = "nerrf:search:generation"
+ENTRY_KEY_PREFIX = "nerrf:search:entry:"
+
+def make_key(query: str, limit: int, cursor: Optional[str], fields: Optional[list], track_total_hits: bool) -> str:
+    """Normalize search parameters into a cache key"""
+    normalized = {
+        "q": " ".join(query.split()),
+        "limit": limit,
+        "cursor": cursor,
+        "fields": sorted(fields) if fields else None,
+        "total": track_total_hits,
+    }
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+class SearchCache:
+    """Bounded LRU + TTL cache with generation-based invalidation"""
+
+    def __init__(self, max_entries: int = SEARCH_CACHE_MAX_ENTRIES, ttl: int = SEARCH_CACHE_TTL, use_redis: bool = SEARCH_CACHE_REDIS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.use_redis = use_redis
+        self.generation = 0
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "generation": self.generation,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    async def _current_generation(self) -> int:
+        if self.use_redis:
+            try:
+                generation = int(await redis_client.get(GENERATION_KEY) or 0)
+                if generation != self.generation:
+                    # Another worker invalidated; drop our stale entries
+                    self._entries.clear()
+                    self.generation = generation
+            except Exception as e:
+                logger.warning(f"Redis search cache read failed: {e}")
+        return self.generation
+
+    async def get(self, key: str) -> Tuple[Optional[dict], int]:
+        """The cached value (or None) and the generation it was looked up under, to pass to set()"""
+        if not SEARCH_CACHE_ENABLED:
+            return None, self.generation
+        generation = await self._current_generation()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, entry_generation, value = entry
+            if entry_generation == generation and expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value, generation
+            del self._entries[key]
+
+        if self.use_redis:
+            try:
+                raw = await redis_client.get(f"{ENTRY_KEY_PREFIX}{generation}:{key}")
+                if raw:
+                    value = json.loads(raw)
+                    self._store_local(key, generation, value)
+                    self.hits += 1
+                    return value, generation
+            except Exception as e:
+                logger.warning(f"Redis search cache read failed: {e}")
+
+        self.misses += 1
+        return None, generation
+
+    async def set(self, key: str, value: dict, generation: int):
+        """Store a result computed after get() returned generation"""
+        if not SEARCH_CACHE_ENABLED:
+            return
+        if generation != self.generation:
+            # Invalidated while the query ran; the result may predate the change
+            return
+        self._store_local(key, generation, value)
+        if self.use_redis:
+            try:
+                await redis_client.set(f"{ENTRY_KEY_PREFIX}{generation}:{key}", json.dumps(value), ex=self.ttl)
+            except Exception as e:
+                logger.warning(f"Redis search cache write failed: {e}")
+
+    def _store_local(self, key: str, generation: int, value: dict):
+        self._entries[key] = (time.monotonic() + self.ttl, generation, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def invalidate(self):
+        """Bump the generation so every cached result is treated as stale"""
+        self._entries.clear()
+        if self.use_redis:
+            try:
+                self.generation = int(await redis_client.incr(GENERATION_KEY))
+                return
+            except Exception as e:
+                logger.warning(f"Redis search cache invalidation failed: {e}")
+        self.generation += 1
+
+search_cache = SearchCache()
@@ -0,0 +1,79 @@
+"""
+Near-duplicate lookup over perceptual hashes.
+
+Processing stores a 64-bit difference hash (dHash) for every image, plus the
+same hash split into four 16-bit segments, each with its own B-tree index
+(multi-index hashing). Two hashes within Hamming distance 3 must agree exactly
+on at least one segment, so a lookup probes the four segment indexes and only
+computes the full distance for those candidates instead of scanning every image.
+The statements work with both the async API session and the sync worker session.
+"""
+from sqlalchemy import select, or_, cast, func
+from sqlalchemy.dialects.postgresql import BIT
+from typing import Optional
+import os
+
+from models import Image as ImageModel
+
+PHASH_BITS = 64
+PHASH_SEGMENTS = 4
+SEGMENT_BITS = PHASH_BITS // PHASH_SEGMENTS
+SEGMENT_MASK = (1 << SEGMENT_BITS) - 1
+
+# Matches up to PHASH_SEGMENTS - 1 are guaranteed to be found; larger values only
+# catch pairs that happen to share a segment
+NEAR_DUPLICATE_DISTANCE = int(os.getenv("NEAR_DUPLICATE_DISTANCE", "3"))
+
+def hash_segments(phash: int) -> list:
+    """Split an unsigned 64-bit hash into its 16-bit segments, most significant first"""
+    return [
+        (phash >> (SEGMENT_BITS * (PHASH_SEGMENTS - 1 - i))) & SEGMENT_MASK
+        for i in range(PHASH_SEGMENTS)
+    ]
+
+def to_signed(phash: int) -> int:
+    """Postgres BIGINT is signed; store the hash's bit pattern as-is"""
+    return phash - (1 << PHASH_BITS) if phash >= 1 << (PHASH_BITS - 1) else phash
+
+def to_unsigned(phash: int) -> int:
+    """Inverse of to_signed, for hashes read back from the phash column"""
+    return phash & ((1 << PHASH_BITS) - 1)
+
+def phash_columns(phash: int) -> dict:
+    """Image columns holding a perceptual hash and its indexed segments"""
+    columns = {"phash": to_signed(phash)}
+    for i, segment in enumerate(hash_segments(phash)):
+        columns[f"phash_{i}"] = segment
+    return columns
+
+def hamming_distance(phash: int):
+    """SQL expression for the Hamming distance between the stored hash and phash"""
+    return func.bit_count(cast(ImageModel.phash.op("#")(to_signed(phash)), BIT(PHASH_BITS)))
+
+def near_duplicates_query(
+    phash: int,
+    max_distance: int = NEAR_DUPLICATE_DISTANCE,
+    exclude_id: Optional[int] = None,
+    limit: int = 10,
+    before_id: Optional[int] = None
+):
+    """SELECT of (id, filename, distance) for images within max_distance of phash, closest first,
+    optionally only those uploaded before before_id"""
+    distance = hamming_distance(phash).label("distance")
+    segment_columns = [ImageModel.phash_0, ImageModel.phash_1, ImageModel.phash_2, ImageModel.phash_3]
+    query = (
+        select(ImageModel.id, ImageModel.filename, distance)
+        # Each branch is an exact match on one indexed segment; Postgres ORs the bitmap scans
+        .where(or_(*[
+            segment_column == segment
+            for segment_column, segment in zip(segment_columns, hash_segments(phash))
+        ]))
+        .where(hamming_distance(phash) <= max_distance)
+        .order_by(distance, ImageModel.id)
+        .limit(limit)
+    )
+    if exclude_id is not None:
+        query = query.where(ImageModel.id != exclude_id)
+    if before_id is not None:
+        query = query.where(ImageModel.id < before_id)
+    return query
@@ -0,0 +1,81 @@
+"""
+Running catalog totals for /stats.
+
+The catalog_stats table holds one row of counters. Uploads, deletes and the
+Celery processing task adjust it in the same transaction as their own writes,
+so /stats is a single primary-key read. reconcile_statement recomputes the
+totals from the images table to correct any drift (run periodically by Celery
+beat and on startup).
+"""
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import select, update, func, literal
+
+from models import Image as ImageModel, CatalogStats
+
+STATS_ROW_ID = 1
+
+def stats_delta_statement(images: int = 0, size: int = 0, processed: int = 0, uploaders: int = 0):
+    """UPDATE that applies a delta to the running totals"""
+    return (
+        update(CatalogStats)
+        .where(CatalogStats.id == STATS_ROW_ID)
+        .values(
+            total_images=CatalogStats.total_images + images,
+            total_size=CatalogStats.total_size + size,
+            processed_images=CatalogStats.processed_images + processed,
+            unique_uploaders=CatalogStats.unique_uploaders + uploaders,
+            updated_at=func.now(),
+        )
+    )
+
+def reconcile_statement(overwrite: bool = True):
+    """
+    INSERT ... SELECT that recomputes the totals from the images table in one statement.
+    With overwrite=False an existing row is left alone (used to seed the row).
+    """
+    aggregates = select(
+        literal(STATS_ROW_ID),
+        func.count(ImageModel.id),
+        func.count(func.distinct(ImageModel.ip_address)),
+        func.coalesce(func.sum(ImageModel.file_size), 0),
+        func.count(ImageModel.id).filter(ImageModel.processed == True),
+    )
+    stmt = pg_insert(CatalogStats).from_select(
+        ["id", "total_images", "unique_uploaders", "total_size", "processed_images"],
+        aggregates,
+    )
+    if not overwrite:
+        return stmt.on_conflict_do_nothing(index_elements=[CatalogStats.id])
+    return stmt.on_conflict_do_update(
+        index_elements=[CatalogStats.id],
+        set_={
+            "total_images": stmt.excluded.total_images,
+            "unique_uploaders": stmt.excluded.unique_uploaders,
+            "total_size": stmt.excluded.total_size,
+            "processed_images": stmt.excluded.processed_images,
+            "updated_at": func.now(),
+        },
+    )
+
+async def apply_stats_delta(db: AsyncSession, images: int = 0, size: int = 0, processed: int = 0, uploaders: int = 0):
+    """Adjust the running totals inside the caller's transaction"""
+    await db.execute(stats_delta_statement(images, size, processed, uploaders))
+
+async def get_catalog_stats(db: AsyncSession) -> dict:
+    """Read the running totals"""
+    result = await db.execute(select(CatalogStats).where(CatalogStats.id == STATS_ROW_ID))
+    row = result.scalar_one_or_none()
+    if row is None:
+        return {"total_images": 0, "unique_uploaders": 0, "total_size": 0, "processed_images": 0}
+    return {
+        "total_images": row.total_images,
+        "unique_uploaders": row.unique_uploaders,
+        "total_size": row.total_size,
+        "processed_images": row.processed_images,
+    }
+
+async def init_stats(db: AsyncSession):
+    """Seed the stats row from the images table if it doesn't exist yet"""
+    await db.execute(reconcile_statement(overwrite=False))
+    await db.commit()
@@ -0,0 +1,295 @@
+"""
+Content-addressed storage for uploaded images.
+
+Originals are stored under a key derived from their SHA-256, sharded by hash
+prefix so no directory grows past a few thousand entries:
+
+    ab/cd/abcd1234...ef.jpg              original
+    thumbs/ab/cd/abcd1234...ef.jpg       thumbnail
+    renditions/ab/cd/abcd1234...ef_640.webp
+
+The key doubles as the image's filename and its URL path under /images/, so
+URLs never change once issued. Files uploaded before the sharded layout keep
+their flat names until migrate_storage.py moves them.
+
+STORAGE_BACKEND selects where keys live: "local" (a directory shared by the API,
+the worker and nginx) or "s3" (any S3-compatible object store, e.g. MinIO). With
+S3, /images/ requests fall through to the API, which redirects to a short-lived
+presigned URL, and the worker downloads originals by key.
+
+Locally, keys live under images/ in the data volume, the only directory nginx
+serves. In-progress uploads are staged in its sibling staging/, on the same
+filesystem so moving them into place is an atomic rename, and out of public reach.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import uuid
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = Path(os.getenv("DATA_DIR", "/app/data"))  # Volume shared by the API, the worker and nginx
+UPLOAD_DIR = DATA_DIR / "images"  # Served by nginx as /images/
+STAGING_DIR = DATA_DIR / "staging"  # Never served
+LEGACY_UPLOAD_DIR = Path("/app/uploads")  # Where the volume was mounted before images/ moved into it
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+S3_BUCKET = os.getenv("S3_BUCKET", "images")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. http://minio:9000; unset for AWS
+S3_PUBLIC_ENDPOINT_URL = os.getenv("S3_PUBLIC_ENDPOINT_URL")  # Browser-reachable endpoint for presigned URLs, if different
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "20"))
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))  # bytes
+S3_MULTIPART_CHUNK_SIZE = int(os.getenv("S3_MULTIPART_CHUNK_SIZE", str(8 * 1024 * 1024)))  # bytes
+S3_PRESIGN_EXPIRES = int(os.getenv("S3_PRESIGN_EXPIRES", "3600"))  # seconds
+
+THUMBNAILS_PREFIX = "thumbs"
+RENDITIONS_PREFIX = "renditions"
+SHARD_DEPTH = 2  # Two levels of two hex characters: 65536 leaf directories
+SHARD_NAME = re.compile(r"[0-9a-f]{2}")
+
+def content_key(file_hash: str, ext: str) -> str:
+    """Storage key for an original, e.g. ab/cd/<sha256>.jpg"""
+    shards = [file_hash[i * 2:i * 2 + 2] for i in range(SHARD_DEPTH)]
+    return "/".join([*shards, f"{file_hash}{ext}"])
+
+def thumbnail_key(key: str) -> str:
+    """Thumbnails mirror the original's key under thumbs/"""
+    return f"{THUMBNAILS_PREFIX}/{key}"
+
+def rendition_key(key: str, width: int, ext: str) -> str:
+    """Renditions mirror the original's shard under renditions/, suffixed with their width"""
+    return f"{rendition_prefix(key)}{width}.{ext}"
+
+def rendition_prefix(key: str) -> str:
+    """Common prefix of every rendition written for an original"""
+    parent, _, name = key.rpartition("/")
+    stem = Path(name).stem
+    return "/".join(part for part in (RENDITIONS_PREFIX, parent, f"{stem}_") if part)
+
+def url_for(key: str) -> str:
+    """Public URL nginx serves a key from"""
+    return f"/images/{key}"
+
+def content_type_for(key: str) -> str:
+    return mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+class LocalStorage:
+    """Keys map to files under a root directory shared by the API and the worker"""
+
+    def __init__(self, root: Path, staging_dir: Optional[Path] = None, legacy_root: Optional[Path] = None):
+        self.root = Path(root)
+        # Uploads are staged next to the root, on the same filesystem, so save() is an atomic rename
+        self.staging_dir = Path(staging_dir) if staging_dir else self.root.with_name(f"{self.root.name}.staging")
+        self.legacy_root = Path(legacy_root) if legacy_root else None
+
+    def init(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        if self.legacy_root is not None:
+            self._adopt_legacy_root()
+
+    def _adopt_legacy_root(self):
+        """
+        Volumes from before images/ existed keep their files at the top level:
+        move shard directories, thumbs/, renditions/ and flat-named originals
+        under the root. Each move is a rename, so this is instant and idempotent.
+        """
+        moved = 0
+        for entry in self.legacy_root.iterdir():
+            name = entry.name
+            if not (
+                name in (THUMBNAILS_PREFIX, RENDITIONS_PREFIX)
+                or (entry.is_dir() and SHARD_NAME.fullmatch(name))
+                or (entry.is_file() and not name.startswith(".") and content_type_for(name).startswith("image/"))
+            ):
+                continue
+            try:
+                os.replace(entry, self.root / name)
+                moved += 1
+            except OSError as e:
+                logger.warning(f"Could not move {entry} under {self.root}: {e}")
+        if moved:
+            logger.info(f"Moved {moved} entries of the old volume layout under {self.root}")
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    def exists(self, key: str) -> bool:
+        return self.path(key).exists()
+
+    def save(self, source: Path, key: str):
+        """Atomically move a file (on the same filesystem) into place under key"""
+        target = self.path(key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source, target)
+
+    def put_bytes(self, key: str, data: bytes):
+        """Write a small file (thumbnail, rendition) under key"""
+        target = self.path(key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = target.with_name(f".{target.name}.{uuid.uuid4().hex}.part")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, target)
+
+    @contextmanager
+    def fetch(self, key: str) -> Iterator[Path]:
+        """Local path of a stored file for the duration of the block"""
+        yield self.path(key)
+
+    def link(self, source_key: str, key: str) -> bool:
+        """
+        Give an existing file a second name without copying it (a hardlink).
+        Returns False if source_key doesn't exist. An existing key is left in
+        place, since content-addressed keys with the same name hold the same bytes.
+        """
+        source = self.path(source_key)
+        target = self.path(key)
+        if not source.exists():
+            return False
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            pass
+        return True
+
+    def delete(self, key: str):
+        self.path(key).unlink(missing_ok=True)
+
+    def delete_prefix(self, prefix: str):
+        """Delete every file whose key starts with prefix, within the prefix's directory"""
+        directory = self.path(prefix).parent
+        if directory.is_dir():
+            for path in directory.glob(f"{Path(prefix).name}*"):
+                if path.is_file():
+                    path.unlink(missing_ok=True)
+
+    def presigned_url(self, key: str) -> Optional[str]:
+        """nginx serves local files directly; there is nothing to redirect to"""
+        return None
+
+class S3Storage:
+    """
+    Keys map to objects in one bucket of an S3-compatible store. A single boto3
+    client (thread-safe, with a bounded connection pool) is shared by the process.
+    """
+
+    def __init__(self, bucket: str, staging_dir: Path):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self.bucket = bucket
+        # Staged uploads sit on the shared volume so the worker can expire abandoned ones
+        self.staging_dir = Path(staging_dir)
+        config = Config(
+            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            retries={"max_attempts": 5, "mode": "standard"},
+            s3={"addressing_style": "path"} if S3_ENDPOINT_URL else None,
+        )
+        credentials = {
+            "region_name": S3_REGION,
+            "aws_access_key_id": S3_ACCESS_KEY_ID,
+            "aws_secret_access_key": S3_SECRET_ACCESS_KEY,
+        }
+        self.client = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL, config=config, **credentials)
+        # Presigning is local computation, so a second client costs no connections
+        self.presign_client = self.client
+        if S3_PUBLIC_ENDPOINT_URL:
+            self.presign_client = boto3.client("s3", endpoint_url=S3_PUBLIC_ENDPOINT_URL, config=config, **credentials)
+        # Large originals go up as parallel multipart uploads streamed from disk
+        self.transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+            max_concurrency=4,
+        )
+
+    def init(self):
+        """Create the staging directory, and the bucket if it doesn't exist (handy for MinIO stand-ins)"""
+        from botocore.exceptions import ClientError
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except ClientError:
+            self.client.create_bucket(Bucket=self.bucket)
+            logger.info(f"Created bucket {self.bucket}")
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError:
+            return False
+
+    def save(self, source: Path, key: str):
+        """Upload a staged file under key, then remove the staged copy"""
+        try:
+            self.client.upload_file(
+                str(source), self.bucket, key,
+                ExtraArgs={"ContentType": content_type_for(key)},
+                Config=self.transfer_config,
+            )
+        finally:
+            Path(source).unlink(missing_ok=True)
+
+    def put_bytes(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=content_type_for(key))
+
+    @contextmanager
+    def fetch(self, key: str) -> Iterator[Path]:
+        """Download an object to a temp file for the duration of the block"""
+        self.staging_dir.mkdir(parents=True, exist_ok=True)  # The worker never runs init()
+        fd, temp_name = tempfile.mkstemp(dir=self.staging_dir, suffix=Path(key).suffix)
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, key, temp_name, Config=self.transfer_config)
+            yield Path(temp_name)
+        finally:
+            os.unlink(temp_name)
+
+    def link(self, source_key: str, key: str) -> bool:
+        """Server-side copy; objects have no hardlinks"""
+        if not self.exists(source_key):
+            return False
+        self.client.copy_object(Bucket=self.bucket, Key=key, CopySource={"Bucket": self.bucket, "Key": source_key})
+        return True
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def delete_prefix(self, prefix: str):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            objects = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True})
+
+    def presigned_url(self, key: str) -> Optional[str]:
+        return self.presign_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=S3_PRESIGN_EXPIRES,
+        )
+
+def create_storage():
+    """Backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(S3_BUCKET, STAGING_DIR)
+    return LocalStorage(UPLOAD_DIR, STAGING_DIR, legacy_root=DATA_DIR)
+
+storage = create_storage()
+
+def delete_image_files(key: str, thumbnail: Optional[str] = None):
+    """Remove an original with its thumbnail and every rendition"""
+    storage.delete(key)
+    storage.delete(thumbnail or thumbnail_key(key))
+    storage.delete_prefix(rendition_prefix(key))
@@ -0,0 +1,108 @@
+"""
+Task progress pushed over Redis pub/sub.
+
+process_image publishes each state change (PROCESSING stages, completion,
+failure) to one channel. Each API process holds a single subscription to that
+channel and fans messages out to the /status/stream connections waiting on the
+task, so clients get updates as they happen instead of polling the Celery
+result backend.
+"""
+from collections import defaultdict
+from typing import Optional
+import asyncio
+import json
+import logging
+
+import redis
+import redis.asyncio as aioredis
+
+from celery_app import REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+TASK_EVENTS_CHANNEL = "nerrf:task-events"
+
+# Terminal statuses end a task's stream
+FINAL_STATUSES = {"completed", "failed"}
+
+_publisher: Optional[redis.Redis] = None
+
+def publish_task_event(task_id: str, event: dict):
+    """Publish a status update for a task (worker side, sync). Failures are only logged."""
+    global _publisher
+    if not task_id:
+        return
+    try:
+        if _publisher is None:
+            _publisher = redis.Redis.from_url(REDIS_URL)
+        _publisher.publish(TASK_EVENTS_CHANNEL, json.dumps({"task_id": task_id, **event}))
+    except Exception as e:
+        logger.warning(f"Failed to publish task event for {task_id}: {e}")
+
+class TaskEventHub:
+    """One pub/sub subscription per process, fanned out to per-connection queues"""
+
+    def __init__(self):
+        self._client: Optional[aioredis.Redis] = None
+        self._task: Optional[asyncio.Task] = None
+        self._listeners = defaultdict(set)  # task_id -> {asyncio.Queue}
+
+    @property
+    def connections(self) -> int:
+        return len({id(queue) for queues in self._listeners.values() for queue in queues})
+
+    def stats(self) -> dict:
+        return {"watched_tasks": len(self._listeners), "connections": self.connections}
+
+    def start(self):
+        if self._task is None:
+            self._client = aioredis.from_url(REDIS_URL, decode_responses=True)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def subscribe(self, task_ids: list, queue: asyncio.Queue):
+        for task_id in task_ids:
+            self._listeners[task_id].add(queue)
+
+    def unsubscribe(self, task_ids: list, queue: asyncio.Queue):
+        for task_id in task_ids:
+            queues = self._listeners.get(task_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._listeners[task_id]
+
+    async def _run(self):
+        while True:
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(TASK_EVENTS_CHANNEL)
+                async for message in pubsub.listen():
+                    self._dispatch(message.get("data"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Reconnect after Redis hiccups; streams fall back to their keepalive until then
+                logger.error(f"Task event subscription failed: {e}")
+                await asyncio.sleep(1)
+
+    def _dispatch(self, data):
+        try:
+            event = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        for queue in list(self._listeners.get(event.get("task_id"), ())):
+            queue.put_nowait(event)
+
+task_events = TaskEventHub()
@@ -0,0 +1,274 @@
+"""
+On-the-fly image transforms: /images/{key}?w=&h=&fmt=
+
+A transform fits the stored image inside a w x h box (never upscaling) and
+encodes it as fmt. Results are rendered on a small thread pool and kept in a
+size-capped disk cache with LRU eviction; concurrent misses for the same
+transform share one render instead of each doing it.
+
+Storage keys are content-addressed, so a transform's bytes never change for a
+given key, size, format and encoder settings. Its cache name is a digest of
+exactly those, which doubles as a strong ETag: conditional requests and
+nginx/CDN caches work without touching the image.
+
+Cache names start with a digest of the source key, so deleting an image
+purges its transforms with one directory scan. Every API worker shares the
+directory, and it is the only index: a file's mtime is its last use, and the
+size cap is enforced by rescanning the directory and evicting the oldest files
+each time a process has written another slice of the cap.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from PIL import Image, UnidentifiedImageError
+from typing import Dict, Optional
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+import uuid
+
+from image_processing import ALLOWED_FORMATS, ENCODERS, MAX_IMAGE_PIXELS, prepare_mode
+from metrics import timed
+from storage import DATA_DIR, storage
+
+logger = logging.getLogger(__name__)
+
+TRANSFORM_CACHE_DIR = Path(os.getenv("TRANSFORM_CACHE_DIR", str(DATA_DIR / "transforms")))
+TRANSFORM_CACHE_MAX_BYTES = int(os.getenv("TRANSFORM_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))  # 1GB
+TRANSFORM_WORKERS = int(os.getenv("TRANSFORM_WORKERS", "4"))
+TRANSFORM_MAX_DIMENSION = int(os.getenv("TRANSFORM_MAX_DIMENSION", "4096"))
+
+TOUCH_INTERVAL = 60  # seconds; hits refresh a file's mtime at most this often
+TEMP_FILE_MAX_AGE = 600  # seconds before a leftover temp file counts as an interrupted write
+
+# Without fmt, originals keep their format (by key extension); GIF and BMP become PNG
+SOURCE_FORMATS = {".jpg": "jpeg", ".jpeg": "jpeg", ".png": "png", ".webp": "webp"}
+
+class DiskLRUCache:
+    """Files in one directory, shared between processes, evicted least recently used first once they exceed max_bytes"""
+
+    def __init__(self, directory: Path, max_bytes: int, scan_fraction: float = 0.05):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        # Each process rescans after writing this much, so together they overshoot by at most workers x this
+        self.scan_every = max(1, int(max_bytes * scan_fraction))
+        self._lock = threading.Lock()
+        self._files = 0  # As of the last scan, plus this process's writes since
+        self._size = 0
+        self._written = 0  # Bytes this process has written since the last scan
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.scan()
+        logger.info(f"Transform cache: {self._files} files, {self._size} bytes")
+
+    def stats(self) -> dict:
+        return {
+            "entries": self._files,
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def scan(self):
+        """Total up the directory, whichever process wrote each file, and evict the least recently used down to max_bytes"""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if entry.name.startswith("."):
+                    if now - stat.st_mtime > TEMP_FILE_MAX_AGE:
+                        os.unlink(entry.path)  # Interrupted write
+                    continue
+            except FileNotFoundError:
+                continue  # Evicted or purged by another process meanwhile
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        files.sort()
+
+        total = sum(size for _, _, size in files)
+        evicted = 0
+        while total > self.max_bytes and len(files) - evicted > 1:
+            _, name, size = files[evicted]
+            (self.directory / name).unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._files = len(files) - evicted
+            self._size = total
+            self._written = 0
+            self.evictions += evicted
+
+    def get(self, name: str) -> Optional[Path]:
+        path = self.directory / name
+        try:
+            mtime = path.stat().st_mtime
+            if time.time() - mtime > TOUCH_INTERVAL:
+                os.utime(path)  # Mark it recently used for every process's next scan
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, name: str, data: bytes) -> Path:
+        """Write atomically; rescans once this process has written scan_every bytes since the last scan"""
+        path = self.directory / name
+        temp_path = self.directory / f".{name}.{uuid.uuid4().hex}"
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._files += 1
+            self._size += len(data)
+            self._written += len(data)
+            scan = self._written >= self.scan_every
+            if scan:
+                self._written = 0  # Claimed; other threads don't start a second scan
+        if scan:
+            self.scan()
+        return path
+
+    def delete_prefix(self, prefix: str) -> int:
+        """Remove every file whose name starts with prefix, whichever process wrote it"""
+        removed = 0
+        for path in self.directory.glob(f"{prefix}*"):
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                self._files -= 1
+                self._size -= size
+            removed += 1
+        return removed
+
+transform_cache = DiskLRUCache(TRANSFORM_CACHE_DIR, TRANSFORM_CACHE_MAX_BYTES)
+_executor = ThreadPoolExecutor(max_workers=TRANSFORM_WORKERS, thread_name_prefix="transform")
+_inflight: Dict[str, asyncio.Future] = {}
+
+def validate_key(key: str) -> str:
+    """Reject keys that could escape the storage root"""
+    path = PurePosixPath(key)
+    if not key or path.is_absolute() or ".." in path.parts:
+        raise ValueError("Invalid image key")
+    return key
+
+def validate_params(w: Optional[int], h: Optional[int], fmt: Optional[str]) -> Optional[str]:
+    """Check a transform's parameters; returns the normalized format"""
+    for name, value in (("w", w), ("h", h)):
+        if value is not None and not 1 <= value <= TRANSFORM_MAX_DIMENSION:
+            raise ValueError(f"{name} must be between 1 and {TRANSFORM_MAX_DIMENSION}")
+    if fmt is not None:
+        fmt = fmt.lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        Image.init()
+        if fmt not in ENCODERS or ENCODERS[fmt][0] not in Image.SAVE:
+            raise ValueError(f"Unsupported format: {fmt}")
+    return fmt
+
+def output_format(key: str, fmt: Optional[str]) -> str:
+    return fmt or SOURCE_FORMATS.get(PurePosixPath(key).suffix.lower(), "png")
+
+def key_prefix(key: str) -> str:
+    """Start of the cache name of every transform of key"""
+    return f"{hashlib.sha256(key.encode()).hexdigest()[:16]}_"
+
+def cache_name(key: str, w: Optional[int], h: Optional[int], fmt: str) -> str:
+    """
+    Key prefix, then a digest of everything that determines the output bytes, plus the extension.
+    Changing an encoder's options changes every name, so stale results are never served.
+    """
+    source = f"{key}|{w}|{h}|{fmt}|{ENCODERS[fmt]}"
+    return f"{key_prefix(key)}{hashlib.sha256(source.encode()).hexdigest()[:32]}.{ENCODERS[fmt][1]}"
+
+def etag_for(name: str) -> str:
+    return f'"{PurePosixPath(name).stem}"'
+
+def _render(key: str, w: Optional[int], h: Optional[int], fmt: str, name: str) -> Path:
+    """Fetch, resize and encode one transform into the cache (runs on the thread pool)"""
+    with timed("transform", "render"):
+        if not storage.exists(key):
+            raise FileNotFoundError(key)
+        with storage.fetch(key) as source:
+            try:
+                img = Image.open(source)
+            except UnidentifiedImageError:
+                raise ValueError("Not a readable image")
+            with img:
+                data = _encode(img, w, h, fmt)
+        path = transform_cache.put(name, data)
+        # The image may have been deleted while it rendered. Deletes remove the
+        # stored files before purging, so either the purge saw this file or the
+        # check below sees the image gone
+        if not storage.exists(key):
+            path.unlink(missing_ok=True)
+            raise FileNotFoundError(key)
+        return path
+
+def _encode(img: Image.Image, w: Optional[int], h: Optional[int], fmt: str) -> bytes:
+    """Resize an opened image into the box and encode it"""
+    width, height = img.size
+    if img.format not in ALLOWED_FORMATS:
+        raise ValueError(f"Unsupported image format: {img.format}")
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ValueError(f"Image too large: {width}x{height} exceeds {MAX_IMAGE_PIXELS} pixels")
+
+    box = (min(w or width, width), min(h or height, height))
+    # JPEGs decode straight at the smallest scale that still covers the box
+    img.draft(None, box)
+    img.load()
+    img.thumbnail(box, Image.LANCZOS, reducing_gap=2.0)
+
+    pil_format, _, options = ENCODERS[fmt]
+    buffer = io.BytesIO()
+    prepare_mode(img, fmt).save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+def media_type(fmt: str) -> str:
+    return Image.MIME[ENCODERS[fmt][0]]
+
+async def get_transform(key: str, w: Optional[int], h: Optional[int], fmt: str, name: str) -> Path:
+    """
+    Cached file of a transform (fmt resolved by output_format, name from
+    cache_name), rendering it on a miss. Concurrent misses for the same
+    transform wait on the same render.
+    Raises FileNotFoundError for unknown keys and ValueError for unusable images.
+    """
+    cached = transform_cache.get(name)
+    if cached is not None:
+        return cached
+
+    render = _inflight.get(name)
+    if render is None:
+        render = asyncio.get_running_loop().run_in_executor(_executor, _render, key, w, h, fmt, name)
+        _inflight[name] = render
+        render.add_done_callback(lambda _: _inflight.pop(name, None))
+    # One client disconnecting mustn't cancel the render for the others
+    return await asyncio.shield(render)
+
+async def transform_source_exists(key: str, name: str) -> bool:
+    """Whether key can still be transformed: a cached result (purged on delete) or the stored image"""
+    if transform_cache.get(name) is not None:
+        return True
+    return await asyncio.get_running_loop().run_in_executor(_executor, storage.exists, key)
+
+def purge_transforms(keys: list):
+    """Drop the cached transforms of deleted images (runs in a thread)"""
+    removed = sum(transform_cache.delete_prefix(key_prefix(key)) for key in keys if key)
+    if removed:
+        logger.info(f"Purged {removed} cached transforms")
+
+def close_transforms():
+    """Stop the render pool, dropping renders nobody has started"""
+    _executor.shutdown(wait=True, cancel_futures=True)
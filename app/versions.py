@@ -0,0 +1,85 @@
+"""
+Version tokens behind the ETags of /stats and /my-uploads.
+
+A generation is a random token in Redis that is replaced whenever the data
+behind a response changes. The catalog generation covers every image (uploads,
+deletes, processing, stats reconciliation) and each IP has its own generation
+for its /my-uploads pages. Handlers read the token before querying and derive
+the ETag from it, so a matching If-None-Match is answered with a 304 from one
+Redis round trip instead of the SQL query.
+
+Random tokens rather than counters mean a key that expires or is flushed can
+never come back with an old value and match a stale ETag. Writers bump after
+their commit, readers read before their query: at worst a client re-downloads
+an unchanged response, never keeps a stale one. If Redis is unavailable no
+ETag is sent and every request gets a full response.
+"""
+from typing import Iterable, List, Optional
+import logging
+import uuid
+
+import redis
+
+from cache import redis_client
+from celery_app import REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+CATALOG_GENERATION_KEY = "nerrf:generation:catalog"
+IP_GENERATION_KEY_PREFIX = "nerrf:generation:ip:"
+IP_GENERATION_TTL = 7 * 24 * 3600  # seconds; an expired token just costs one full response
+
+def ip_generation_key(ip_address: str) -> str:
+    return f"{IP_GENERATION_KEY_PREFIX}{ip_address}"
+
+def _bump_keys(ip_addresses: Iterable[str]) -> List[str]:
+    return [CATALOG_GENERATION_KEY, *(ip_generation_key(ip) for ip in set(ip_addresses) if ip)]
+
+def _new_token() -> str:
+    return uuid.uuid4().hex[:16]
+
+def _ttl(key: str) -> Optional[int]:
+    return IP_GENERATION_TTL if key.startswith(IP_GENERATION_KEY_PREFIX) else None
+
+async def get_generations(keys: List[str]) -> Optional[List[str]]:
+    """Current tokens for keys, creating any that are missing; None if Redis is unavailable"""
+    try:
+        tokens = await redis_client.mget(keys)
+        for index, (key, token) in enumerate(zip(keys, tokens)):
+            if token is None:
+                token = _new_token()
+                # Another worker may have created it first; use whichever token won
+                if not await redis_client.set(key, token, nx=True, ex=_ttl(key)):
+                    token = await redis_client.get(key)
+                if token is None:
+                    return None
+                tokens[index] = token
+        return tokens
+    except Exception as e:
+        logger.warning(f"Failed to read generations: {e}")
+        return None
+
+async def bump_generations(ip_addresses: Iterable[str] = ()):
+    """Replace the catalog token and those of the given IPs (API side, after commit)"""
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in _bump_keys(ip_addresses):
+                pipe.set(key, _new_token(), ex=_ttl(key))
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to bump generations: {e}")
+
+_client: Optional[redis.Redis] = None
+
+def bump_generations_sync(ip_addresses: Iterable[str] = ()):
+    """Worker-side bump_generations"""
+    global _client
+    try:
+        if _client is None:
+            _client = redis.Redis.from_url(REDIS_URL)
+        with _client.pipeline(transaction=False) as pipe:
+            for key in _bump_keys(ip_addresses):
+                pipe.set(key, _new_token(), ex=_ttl(key))
+            pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to bump generations: {e}")
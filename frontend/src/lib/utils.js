@@ -4,3 +4,10 @@ import { twMerge } from "tailwind-merge"
 export function cn(...inputs) {
   return twMerge(clsx(inputs))
 }
+
+// Build an <img srcSet> from the renditions recorded by image processing
+export function buildSrcSet(apiUrl, renditions, format = 'webp') {
+  const matching = (renditions || []).filter((r) => r.format === format)
+  if (matching.length === 0) return undefined
+  return matching.map((r) => `${apiUrl}${r.url} ${r.width}w`).join(', ')
+}
@@ -5,6 +5,7 @@ import { Card, CardContent } from '../components/ui/card';
 import { Badge } from '../components/ui/badge';
 import { Button } from '../components/ui/button';
 import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle } from '../components/ui/dialog';
+import { buildSrcSet } from '../lib/utils';
 
 const API_URL = process.env.REACT_APP_API_URL || 'http://localhost';
 
@@ -191,6 +192,8 @@ function SearchPage() {
                       {image.thumbnail_url ? (
                         <img
                           src={`${API_URL}${image.thumbnail_url}`}
+                          srcSet={buildSrcSet(API_URL, image.renditions)}
+                          sizes="(min-width: 1280px) 25vw, (min-width: 1024px) 33vw, (min-width: 640px) 50vw, 100vw"
                           alt={image.name || 'Image'}
                           className="w-full h-full object-cover group-hover:scale-110 transition-transform duration-300"
                           onError={(e) => {
@@ -275,6 +278,8 @@ function SearchPage() {
                   <div className="rounded-xl overflow-hidden border-2 border-purple-200 dark:border-purple-800 shadow-xl bg-gray-100 dark:bg-gray-800">
                     <img
                       src={`${API_URL}${selectedImage.url}`}
+                      srcSet={buildSrcSet(API_URL, selectedImage.renditions)}
+                      sizes="(min-width: 896px) 896px, 100vw"
                       alt={selectedImage.name || 'Image'}
                       className="w-full h-auto"
                     />
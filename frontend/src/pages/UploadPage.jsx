@@ -44,7 +44,7 @@ function UploadPage() {
 
   const loadStats = async () => {
     try {
-      const response = await fetch(`${API_URL}/my-uploads`);
+      const response = await fetch(`${API_URL}/my-uploads?limit=0`);
       const data = await response.json();
 
       setStats({
@@ -151,36 +151,31 @@ function UploadPage() {
     }
   };
 
-  const checkTaskStatus = async (taskId) => {
-    const maxAttempts = 10;
-    let attempts = 0;
-
-    const interval = setInterval(async () => {
-      attempts++;
-
-      try {
-        const response = await fetch(`${API_URL}/status/${taskId}`);
-        const data = await response.json();
-
-        if (data.status === 'completed') {
-          clearInterval(interval);
-          setUploadResult(prev => ({
-            ...prev,
-            processing_complete: true
-          }));
-        } else if (data.status === 'failed') {
-          clearInterval(interval);
-          setUploadResult(prev => ({
-            ...prev,
-            processing_failed: true
-          }));
-        } else if (attempts >= maxAttempts) {
-          clearInterval(interval);
-        }
-      } catch (error) {
-        clearInterval(interval);
+  const checkTaskStatus = (taskId) => {
+    // The API pushes each status change; the stream closes once the task finishes
+    const source = new EventSource(`${API_URL}/status/stream?task_ids=${encodeURIComponent(taskId)}`);
+
+    source.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+
+      if (data.status === 'completed') {
+        source.close();
+        setUploadResult(prev => ({
+          ...prev,
+          processing_complete: true
+        }));
+      } else if (data.status === 'failed') {
+        source.close();
+        setUploadResult(prev => ({
+          ...prev,
+          processing_failed: true
+        }));
       }
-    }, 2000);
+    };
+
+    source.onerror = () => {
+      source.close();
+    };
   };
 
   return (
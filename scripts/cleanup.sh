@@ -4,26 +4,43 @@ echo "========================================="
 echo "Starting daily cleanup - $(date)"
 echo "========================================="
 
-# Delete all uploaded files
+# Delete all uploaded files, staged and resumable uploads, cached transforms and
+# the legacy URL map, keeping the top-level directories the services write into
 echo "Deleting all uploaded files..."
-rm -rf /app/uploads/*
+find /app/data -mindepth 1 -maxdepth 1 -type f -delete
+find /app/data -mindepth 2 -delete
 echo "✓ All files deleted"
 
 # Truncate database tables
 echo "Truncating database tables..."
 PGPASSWORD=$POSTGRES_PASSWORD psql -h postgres -U $POSTGRES_USER -d $POSTGRES_DB <<-EOSQL
     TRUNCATE images, upload_limits CASCADE;
+    UPDATE catalog_stats SET total_images = 0, unique_uploaders = 0, total_size = 0, processed_images = 0;
 EOSQL
 echo "✓ Database tables truncated"
 
-# Delete Elasticsearch index
-echo "Deleting Elasticsearch index..."
-curl -X DELETE "http://elasticsearch:9200/images" 2>/dev/null
-echo ""
-echo "✓ Elasticsearch index deleted"
+# Replace the Elasticsearch index with an empty one. images is an alias once
+# reindex.py has run and ES refuses to delete an index by its alias, so create a
+# new images_v<timestamp> index (the index template installed by the API
+# supplies the mapping), then point the alias at it and delete the concrete
+# indices behind it, plus any kept with --keep-old, by name in one atomic call
+echo "Recreating Elasticsearch index..."
+ES_URL="http://elasticsearch:9200"
+NEW_INDEX="images_v$(date -u +%Y%m%d%H%M%S)"
+OLD_INDICES=$(curl -s "$ES_URL/_cat/indices/images*?h=index" | tr -d ' ')
+curl -s -X PUT "$ES_URL/$NEW_INDEX" > /dev/null
+ACTIONS="{\"add\": {\"index\": \"$NEW_INDEX\", \"alias\": \"images\", \"is_write_index\": true}}"
+for INDEX in $OLD_INDICES; do
+    ACTIONS="$ACTIONS, {\"remove_index\": {\"index\": \"$INDEX\"}}"
+done
+curl -s -X POST "$ES_URL/_aliases" -H 'Content-Type: application/json' \
+    -d "{\"actions\": [$ACTIONS]}" > /dev/null
+echo "✓ Elasticsearch index recreated"
 
-# Recreate Elasticsearch index (will be recreated on next FastAPI restart)
-echo "Index will be recreated automatically on next upload"
+# Clear cached upload counts and file hashes
+echo "Clearing Redis cache..."
+redis-cli -h redis --scan --pattern 'nerrf:*' | xargs -r redis-cli -h redis DEL > /dev/null
+echo "✓ Redis cache cleared"
 
 echo "========================================="
 echo "Daily cleanup completed - $(date)"